@@ -0,0 +1,238 @@
+"""
+Peak memory of the daily batch jobs over many synthetic variants.
+
+python benchmarks/daily_memory_benchmark.py [variants] [mongodb uri|mongomock]
+
+Each job runs in its own process against the same synthetic variants and charts:
+load_all holds every variant and chart as a document the way the jobs did before they streamed, stream only
+reads the variants through the sweep's sorted cursor and item chunks, sweep runs get_daily_price_and_stock
+against a local Shopee stub and thresholds runs update_chart_variants. The reported growth is the resident
+memory sampled during the job above what the process held once the data was in place.
+Runs against a local mongod by default, the database is dropped afterwards. With mongomock every process seeds
+its own copy, the copy counts towards the baseline, and the bulk writes of the sweep are slow.
+Run from the repo root with credentials.py present.
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta
+from mongoengine import connect
+import subprocess
+import threading
+import resource
+import logging
+import random
+import json
+import time
+import sys
+import gc
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+VARIANTS = 50000
+VARIANTS_PER_ITEM = 3
+VARIANTS_PER_CHART = 2
+DAYS = 365
+PRICE_CHANGES = 12
+SEED_CHUNK_SIZE = 1000
+SAMPLE_SECONDS = 0.005
+JOBS = ["load_all", "stream", "sweep", "thresholds"]
+LOCAL_DB_URI = "mongodb://localhost:27017"
+BENCHMARK_DATABASE = "eyesontheprice_benchmark"
+
+
+class ShopeeStub(BaseHTTPRequestHandler):
+    """
+    Answers item/get with every model of the item, model ids are itemid * 10 + model index
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        item_id = int(parse_qs(urlparse(self.path).query)['itemid'][0])
+        models = [{"modelid": item_id * 10 + k, "price": 100000 * (1000 + item_id % 97 + k), "stock": 5}
+                  for k in range(VARIANTS_PER_ITEM)]
+        data = json.dumps({"item": {"itemid": item_id, "price_min": models[0]["price"], "stock": 15,
+                                    "models": models}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def get_variant(variant_index, start, rng):
+    import series_utils
+    item_index = variant_index // VARIANTS_PER_ITEM
+    change_days = sorted(rng.sample(range(1, DAYS), PRICE_CHANGES))
+    price = rng.randint(500, 50000)
+    price_history = [{"date": start, "price": price}]
+    prices = []
+    for day in range(DAYS):
+        if change_days and day == change_days[0]:
+            change_days.pop(0)
+            price = max(100, price + rng.randint(-2000, 2000))
+            price_history.append({"date": start + timedelta(days=day), "price": price})
+        prices.append(price)
+    dates = [(start + timedelta(days=day)).strftime("%Y-%m-%d") for day in range(DAYS)]
+    return {
+        "_id": str(item_index * 10 + variant_index % VARIANTS_PER_ITEM),
+        "item_id": str(item_index),
+        "shop_id": str(item_index % 1000),
+        "channel": "shopee",
+        "item_name": f"Synthetic item {item_index} with a name as long as a real listing has",
+        "variant_name": f"Variant {variant_index % VARIANTS_PER_ITEM}",
+        "created_time": start,
+        "created_price": price_history[0]["price"],
+        "current_price": price,
+        "lowest_price": min(prices),
+        "price_history": price_history,
+        "price_series": series_utils.encode_price_series(dates, prices),
+        "stock": 5,
+        "item_url": f"https://shopee.sg/product/{item_index % 1000}/{item_index}",
+    }
+
+
+def get_chart(chart_index, variants):
+    return {
+        "chart_id": str(chart_index),
+        "chat_id": str(chart_index % 5000),
+        "chart_name": f"Chart {chart_index}",
+        "threshold": -20,
+        "variants": [{"_id": variant["_id"], "channel": "shopee", "item_name": variant["item_name"],
+                      "variant_name": variant["variant_name"], "created_price": variant["created_price"],
+                      "current_price": variant["current_price"], "item_url": variant["item_url"]}
+                     for variant in variants],
+    }
+
+
+def seed(variant_count):
+    import db_models
+    rng = random.Random(25)
+    start = datetime.combine(datetime.now().date() - timedelta(days=DAYS), datetime.min.time())
+    variant_collection = db_models.ItemVariant._get_collection()
+    chart_collection = db_models.Chart._get_collection()
+    for chunk_start in range(0, variant_count, SEED_CHUNK_SIZE):
+        variants = [get_variant(i, start, rng)
+                    for i in range(chunk_start, min(variant_count, chunk_start + SEED_CHUNK_SIZE))]
+        variant_collection.insert_many(variants)
+        chart_collection.insert_many([get_chart(chunk_start + i, variants[i:i + VARIANTS_PER_CHART])
+                                      for i in range(0, len(variants), VARIANTS_PER_CHART)])
+    db_models.ItemVariant.ensure_indexes()
+    db_models.Chart.ensure_indexes()
+
+
+def get_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def sample_peak_rss(stopped, peak):
+    while not stopped.is_set():
+        peak[0] = max(peak[0], get_rss())
+        time.sleep(SAMPLE_SECONDS)
+
+
+def load_all():
+    # what the jobs held before they streamed: every variant and every chart as a document
+    import db_models
+    import db_utils
+    item_variants = {}
+    for variant in db_models.ItemVariant.objects():
+        item_variants.setdefault((variant.item_id, variant.shop_id), []).append(variant)
+    charts = list(db_utils.get_chart_query())
+    return {'items': len(item_variants), 'charts': len(charts)}
+
+
+def stream():
+    import daily_shopee
+    import db_models
+    import db_utils
+    import utils
+    variants = db_utils.stream_documents(db_models.ItemVariant.objects(channel="shopee").order_by("item_id", "shop_id"),
+                                         daily_shopee.get_sweep_fields(), raw=False)
+    item_count = 0
+    for item_chunk in utils.get_chunks(daily_shopee.group_variants_by_item(variants), db_utils.BULK_WRITE_CHUNK_SIZE):
+        item_count += len(item_chunk)
+    return {'items': item_count}
+
+
+def sweep():
+    import daily_shopee
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ShopeeStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        changed_variant_ids = daily_shopee.get_daily_price_and_stock(
+            search_link=f"http://127.0.0.1:{server.server_port}/api/v2/item/get?")
+    finally:
+        server.shutdown()
+    return {'changed': len(changed_variant_ids)}
+
+
+def thresholds():
+    import daily_shopee
+    daily_shopee.update_chart_variants()
+    return {}
+
+
+def run_job(job, variant_count, host):
+    if host == "mongomock":
+        import mongomock
+        connect(BENCHMARK_DATABASE, host="mongodb://localhost", mongo_client_class=mongomock.MongoClient)
+        seed(variant_count)
+    else:
+        connect(BENCHMARK_DATABASE, host=host)
+    import daily_shopee
+    # the jobs log every variant and chart
+    logging.disable(logging.INFO)
+
+    gc.collect()
+    baseline = get_rss()
+    peak = [baseline]
+    stopped = threading.Event()
+    sampler = threading.Thread(target=sample_peak_rss, args=(stopped, peak), daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    result = globals()[job]()
+    seconds = time.perf_counter() - start
+    stopped.set()
+    sampler.join()
+    return {
+        'job': job,
+        'variants': variant_count,
+        'database': host,
+        **result,
+        'seconds': round(seconds, 3),
+        'baseline_rss_mib': round(baseline / 2 ** 20, 1),
+        'peak_growth_mib': round((peak[0] - baseline) / 2 ** 20, 1),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main(variant_count=VARIANTS, host=LOCAL_DB_URI):
+    db = None
+    if host != "mongomock":
+        db = connect(BENCHMARK_DATABASE, host=host)
+        db.drop_database(BENCHMARK_DATABASE)
+        seed(variant_count)
+    try:
+        for job in JOBS:
+            result = subprocess.run([sys.executable, __file__, "--job", job, str(variant_count), host],
+                                    capture_output=True, text=True)
+            if result.returncode != 0:
+                print(json.dumps({'job': job, 'error': f"exited with {result.returncode}"}))
+                continue
+            print(result.stdout.strip().splitlines()[-1])
+    finally:
+        if db is not None:
+            db.drop_database(BENCHMARK_DATABASE)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--job":
+        print(json.dumps(run_job(sys.argv[2], int(sys.argv[3]), sys.argv[4])))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else VARIANTS, sys.argv[2] if len(sys.argv) > 2 else LOCAL_DB_URI)
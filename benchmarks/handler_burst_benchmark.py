@@ -0,0 +1,135 @@
+"""
+Handler latency under a simulated burst of users.
+
+python benchmarks/handler_burst_benchmark.py [users] [messages per user]
+
+Runs a Dispatcher with bot.py's per-chat ordering handlers and a conversation whose handlers sleep as long as
+the Shopee fetch and chart render usually take. It runs once with the handlers in the dispatcher thread and once
+on the run_async worker pool. Every user sends its messages faster than they are handled. Reported latency is
+the time from an update entering the update queue to its handler finishing. Each mode runs in its own process,
+run_async uses the first Dispatcher of a process.
+Run from the repo root with credentials.py present, bot.py imports it.
+"""
+from datetime import datetime
+from queue import Queue
+import subprocess
+import statistics
+import threading
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+USERS = 50
+MESSAGES = 3
+# seconds between a user's messages, shorter than a handler so later messages arrive while it runs
+MESSAGE_GAP_SECONDS = 0.05
+FETCH_SECONDS = 0.3
+RENDER_SECONDS = 0.5
+CHOOSE, DONE = range(2)
+
+
+def run_burst(mode, users, messages):
+    import telegram
+    from telegram.ext import (Dispatcher, ConversationHandler, MessageHandler, TypeHandler, Filters,
+                              DictPersistence)
+    from telegram.ext.dispatcher import run_async
+    import bot
+
+    arrivals = {}
+    handled = {}
+    handled_order = {}
+    lock = threading.Lock()
+    all_handled = threading.Event()
+
+    def record(update):
+        with lock:
+            handled[update.update_id] = time.perf_counter()
+            handled_order.setdefault(update.effective_chat.id, []).append(int(update.message.text))
+            if len(handled) == users * messages:
+                all_handled.set()
+
+    def wrap(func):
+        func = bot.persist_state(bot.timed(func))
+        return run_async(func) if mode == "run_async" else func
+
+    def fetch_item(update, context):
+        time.sleep(FETCH_SECONDS)
+        record(update)
+        return CHOOSE
+
+    def render_chart(update, context):
+        time.sleep(RENDER_SECONDS)
+        record(update)
+        return ConversationHandler.END
+
+    telegram_bot = telegram.Bot(token="123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11")
+    # the dispatcher names its threads after the bot, skip the getMe and getMyCommands calls
+    telegram_bot.bot = telegram.User(123456, "benchmark", is_bot=True)
+    telegram_bot._commands = []
+    dispatcher = Dispatcher(telegram_bot, Queue(),
+                            workers=bot.HANDLER_WORKERS, persistence=DictPersistence(), use_context=True)
+    dispatcher.add_handler(TypeHandler(telegram.Update, bot.hold_waiting_update), group=-2)
+    dispatcher.add_handler(TypeHandler(telegram.Update, bot.mark_update_handled), group=1)
+    dispatcher.add_handler(ConversationHandler(
+        entry_points=[MessageHandler(Filters.text, wrap(fetch_item))],
+        states={
+            CHOOSE: [MessageHandler(Filters.text, wrap(render_chart))],
+            ConversationHandler.WAITING: [MessageHandler(Filters.all, bot.wait_for_previous_update)],
+        },
+        fallbacks=[],
+        name=bot.CONVERSATION_NAME,
+        persistent=True,
+    ))
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+
+    start = time.perf_counter()
+    update_id = 0
+    for message in range(messages):
+        for user in range(users):
+            update_id += 1
+            telegram_user = telegram.User(user + 1, f"user {user}", is_bot=False)
+            update = telegram.Update(update_id, message=telegram.Message(
+                update_id, telegram_user, datetime.now(), telegram.Chat(user + 1, 'private'), text=str(message)))
+            arrivals[update_id] = time.perf_counter()
+            dispatcher.update_queue.put(update)
+        time.sleep(MESSAGE_GAP_SECONDS)
+    finished = all_handled.wait(users * messages * (FETCH_SECONDS + RENDER_SECONDS) + 30)
+    total_seconds = time.perf_counter() - start
+    dispatcher.stop()
+
+    latencies = [handled[update_id] - arrivals[update_id] for update_id in handled]
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0] * 99
+    return {
+        'mode': mode,
+        'users': users,
+        'updates': users * messages,
+        'handled': len(handled),
+        'finished': finished,
+        'in_order': all(order == list(range(messages)) for order in handled_order.values()),
+        'p50_seconds': round(percentiles[49], 3),
+        'p95_seconds': round(percentiles[94], 3),
+        'p99_seconds': round(percentiles[98], 3),
+        'max_seconds': round(max(latencies), 3) if latencies else None,
+        'total_seconds': round(total_seconds, 3),
+    }
+
+
+def main(users=USERS, messages=MESSAGES):
+    for mode in ["dispatcher_thread", "run_async"]:
+        result = subprocess.run([sys.executable, __file__, "--mode", mode, str(users), str(messages)],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            print(json.dumps({'mode': mode, 'error': f"exited with {result.returncode}"}))
+            continue
+        print(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--mode":
+        print(json.dumps(run_burst(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))))
+    else:
+        main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,96 @@
+"""
+Flush cost of MongoPersistence with many active chats.
+
+python benchmarks/persistence_flush_benchmark.py [chats] [mongodb uri|mongomock]
+
+Marks every chat's chat_data the way the dispatcher does after each update and times the flush when every chat
+is new, when nothing changed, and when a few chats changed, then times writing single chats right away as a
+handler's new conversation state is. Runs against a local mongod by default, the database is dropped afterwards.
+Run from the repo root with credentials.py present.
+"""
+from mongoengine import connect
+import statistics
+import random
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import persistence_utils
+
+CHATS = 20000
+CHANGED_SHARE = 0.01
+WRITE_CHAT_SAMPLES = 500
+LOCAL_DB_URI = "mongodb://localhost:27017"
+BENCHMARK_DATABASE = "eyesontheprice_benchmark"
+
+
+def get_chat_data(chat_id, rng):
+    return {
+        'chat_id': str(chat_id),
+        'channel': 'shopee',
+        'item_url': f"https://shopee.sg/product/{rng.randint(1, 10 ** 9)}/{rng.randint(1, 10 ** 10)}",
+        'items': [{'item_id': str(rng.randint(1, 10 ** 10)), 'item_name': "Synthetic item " * 4}
+                  for _ in range(rng.randint(0, 3))],
+        'threshold': -rng.choice([10, 20, 30]),
+    }
+
+
+def time_flush(persistence, chat_data):
+    for chat_id, data in chat_data.items():
+        persistence.update_chat_data(chat_id, data)
+    flushed_count = persistence.flushed_count
+    skipped_count = persistence.skipped_count
+    start = time.perf_counter()
+    persistence.write()
+    return {
+        'seconds': round(time.perf_counter() - start, 3),
+        'written': persistence.flushed_count - flushed_count,
+        'skipped': persistence.skipped_count - skipped_count,
+    }
+
+
+def run(chats, host):
+    rng = random.Random(18)
+    # flushed by hand, the flush thread does not come round during the benchmark
+    persistence = persistence_utils.MongoPersistence(write_behind_seconds=3600)
+    chat_data = persistence.get_chat_data()
+    for chat_id in range(chats):
+        chat_data[chat_id] = get_chat_data(chat_id, rng)
+
+    results = {'chats': chats, 'database': host}
+    results['flush_all_new'] = time_flush(persistence, chat_data)
+    results['flush_unchanged'] = time_flush(persistence, chat_data)
+    for chat_id in rng.sample(range(chats), int(chats * CHANGED_SHARE)):
+        chat_data[chat_id]['threshold'] -= 10
+    results[f'flush_{CHANGED_SHARE:.0%}_changed'] = time_flush(persistence, chat_data)
+
+    write_chat_seconds = []
+    for chat_id in rng.sample(range(chats), min(chats, WRITE_CHAT_SAMPLES)):
+        chat_data[chat_id]['chosen_variant'] = str(rng.randint(1, 10 ** 10))
+        start = time.perf_counter()
+        persistence.update_conversation("tracking", (chat_id, chat_id), rng.randint(0, 10))
+        write_chat_seconds.append(time.perf_counter() - start)
+    persistence.stopped.set()
+    percentiles = statistics.quantiles(write_chat_seconds, n=100)
+    results['write_chat_ms'] = {
+        'p50': round(1000 * percentiles[49], 3),
+        'p99': round(1000 * percentiles[98], 3),
+    }
+    return results
+
+
+if __name__ == '__main__':
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else CHATS
+    host = sys.argv[2] if len(sys.argv) > 2 else LOCAL_DB_URI
+    if host == "mongomock":
+        import mongomock
+        db = connect(BENCHMARK_DATABASE, host="mongodb://localhost", mongo_client_class=mongomock.MongoClient)
+    else:
+        db = connect(BENCHMARK_DATABASE, host=host)
+    try:
+        print(json.dumps(run(chats, host)))
+    finally:
+        db.drop_database(BENCHMARK_DATABASE)
@@ -0,0 +1,95 @@
+"""
+Render time and peak memory of the chart backends in render_utils.RENDERERS.
+
+python benchmarks/render_benchmark.py [charts] [days]
+
+Each backend runs in its own process so its peak RSS is not mixed with the other's. The plotly backend
+needs kaleido and a Chrome it can start, the browser's memory is reported as children RSS.
+Run from the repo root with credentials.py present, the chart modules import the bot.
+"""
+from datetime import date, timedelta
+import subprocess
+import resource
+import random
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CHARTS = 50
+DAYS = 365
+VARIANTS_PER_CHART = 3
+
+
+def get_chart_data(days, variant_count, rng):
+    start = date.today() - timedelta(days=days - 1)
+    date_lists = []
+    price_lists = []
+    for _ in range(variant_count):
+        price = rng.randint(500, 50000)
+        prices = []
+        for _ in range(days):
+            if rng.random() < 0.05:
+                price = max(100, price + rng.randint(-2000, 2000))
+            prices.append(price)
+        date_lists.append([str(start + timedelta(days=d)) for d in range(days)])
+        price_lists.append(prices)
+    return {
+        'date_lists': date_lists,
+        'price_lists': price_lists,
+        'variants': [f"Variant {i}" for i in range(variant_count)],
+        'items': [f"Synthetic item {i} with a long enough name" for i in range(variant_count)],
+        'created_prices': [price_list[0] for price_list in price_lists],
+        'created_dates': [start] * variant_count,
+    }
+
+
+def run_renderer(name, charts, days):
+    import render_utils
+    rng = random.Random(12)
+    chart_data = [get_chart_data(days, VARIANTS_PER_CHART, rng) for _ in range(charts)]
+    renderer = render_utils.get_renderer(name)
+    try:
+        start = time.perf_counter()
+        renderer.warm_up()
+        warm_up_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        image_bytes = sum(len(renderer.render(data, "Benchmark")) for data in chart_data)
+        render_seconds = time.perf_counter() - start
+    except Exception as e:
+        return {'renderer': name, 'error': f"{type(e).__name__}: {str(e).strip().splitlines()[0]}"}
+    finally:
+        renderer.close()
+    return {
+        'renderer': name,
+        'charts': charts,
+        'days': days,
+        'warm_up_seconds': round(warm_up_seconds, 3),
+        'render_seconds': round(render_seconds, 3),
+        'ms_per_chart': round(1000 * render_seconds / charts, 2),
+        'mean_png_bytes': image_bytes // charts,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_children_rss_mib': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def main(charts=CHARTS, days=DAYS):
+    import render_utils
+    for name in render_utils.RENDERERS:
+        result = subprocess.run([sys.executable, __file__, "--renderer", name, str(charts), str(days)],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            print(json.dumps({'renderer': name, 'error': f"exited with {result.returncode}"}))
+            continue
+        print(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--renderer":
+        print(json.dumps(run_renderer(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))))
+    else:
+        main(*(int(arg) for arg in sys.argv[1:3]))
@@ -14,16 +14,24 @@ bot.
 """
 import plotly_utils
 import utils, db_utils, shopee_utils
+import persistence_utils
 import logging
 from credentials import TELEGRAM_TOKEN
 from telegram import (ReplyKeyboardMarkup, ReplyKeyboardRemove)
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters,
-                          ConversationHandler)
+                          ConversationHandler, TypeHandler, DispatcherHandlerStop)
+from telegram.ext.dispatcher import run_async
+from functools import wraps
+import collections
+import statistics
+import threading
+import time
 import telegram
 from datetime import datetime
 import os
 import shutil
 import sys
+import io
 
 
 bot = telegram.Bot(token=TELEGRAM_TOKEN)
@@ -51,6 +59,31 @@ DELETE_CHART \
 
 SUPPORTED_CHANNELS = ['shopee']
 
+# Slow handlers run on the dispatcher's worker pool, one update per chat at a time
+HANDLER_WORKERS = 16
+# Seconds a held update waits for the one before it to be dispatched before it is released anyway
+RELEASE_TIMEOUT_SECONDS = 30
+LATENCY_REPORT_SECONDS = 300
+
+handler_latencies = collections.deque(maxlen=1000)
+
+# conversation key to the deque of updates waiting for the chat's running handler, in arrival order
+waiting_updates = {}
+# update_id of each update put back on the queue to the event set once the dispatcher handled it
+released_updates = {}
+waiting_updates_lock = threading.Lock()
+
+# Conversation states and chat_data are stored under this name, shared by every bot process
+CONVERSATION_NAME = "tracking"
+
+# Updates arrive by long polling, or over HTTP when one or more bot processes run behind a webhook endpoint
+UPDATE_MODE = "polling"
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+# Public https url of the endpoint, TLS is terminated in front of the bot processes. None to not register it
+WEBHOOK_URL = None
+WEBHOOK_MAX_CONNECTIONS = 40
+
 start_reply_keyboard = [["Let's go!"]]
 
 returning_reply_keyboard = [['Track price of new product',
@@ -74,6 +107,43 @@ chart_reply_keyboard = ['Find chart',
                         ]
 
 
+def timed(func):
+    """
+    Record how long a handler takes in handler_latencies
+    """
+    @wraps(func)
+    def timed_func(update, context):
+        start_time = time.perf_counter()
+        try:
+            return func(update, context)
+        finally:
+            handler_latencies.append(time.perf_counter() - start_time)
+    return timed_func
+
+
+def persist_state(func):
+    """
+    Store chat_data and the returned conversation state once a run_async handler is done,
+    the dispatcher only stores them when the handler starts. They are written before the handler's
+    promise resolves, so the chat's next update finds them in any bot process
+    """
+    @wraps(func)
+    def persisted_func(update, context):
+        new_state = func(update, context)
+        persistence = context.dispatcher.persistence
+        if persistence is not None:
+            context.dispatcher.update_persistence(update=update)
+            if new_state is not None:
+                # a new state is written right away together with the chat's chat_data
+                key = (update.effective_chat.id, update.effective_user.id)
+                persistence.update_conversation(CONVERSATION_NAME, key,
+                                                None if new_state == ConversationHandler.END else new_state)
+            elif isinstance(persistence, persistence_utils.MongoPersistence):
+                persistence.write_chat(update.effective_chat.id)
+        return new_state
+    return persisted_func
+
+
 def start(update, context):
     context_clear(context)
     # First time user flow
@@ -119,6 +189,9 @@ def prompt_url(update, context):
     return CHOOSE_VARIANT
 
 
+@run_async
+@persist_state
+@timed
 def get_url_and_display_variant(update, context):
     user = context.chat_data['user']
 
@@ -137,7 +210,12 @@ def get_url_and_display_variant(update, context):
 
             # Store in context
             context_store_item(item_dict, context)
-            context.chat_data['item_url'] = utils.shorten_url([search_url])[0]
+            if utils.SHORTEN_AFTER_REPLY:
+                # replaced by the short url once the user picks a variant
+                utils.shorten_url_later(search_url)
+                context.chat_data['item_url'] = search_url
+            else:
+                context.chat_data['item_url'] = utils.shorten_url([search_url])[0]
             context.chat_data['channel'] = utils.extract_domain(search_url)
             context.chat_data['variants'] = variants_dict
             logger.info(context.chat_data['variants'])
@@ -166,6 +244,8 @@ def get_variants(update, context):
     logger.info(f"{user.first_name} chose {chosen_variant}")
 
     # Store in context
+    if utils.SHORTEN_AFTER_REPLY:
+        context.chat_data['item_url'] = utils.get_short_url(context.chat_data['item_url'])
     context.chat_data['variants'][chosen_variant_index]['item_url'] = context.chat_data['item_url']
     context_store_item_variant(context.chat_data['variants'][chosen_variant_index], context)
     context.chat_data['chosen_variant'] = chosen_variant
@@ -192,6 +272,9 @@ def get_chart_name(update, context):
         return TYPE_CHART_NAME
 
 
+@run_async
+@persist_state
+@timed
 def display_threshold(update, context):
     user = context.chat_data['user']
     chat_id = str(update.message.chat.id)
@@ -214,6 +297,9 @@ def display_threshold(update, context):
         return get_chart_name(update, context)
 
 
+@run_async
+@persist_state
+@timed
 def get_threshold_and_send_graph(update, context):
     user = context.chat_data['user']
     chosen_threshold = update.message.text
@@ -254,21 +340,22 @@ def send_first_graph(update, context):
     chat_id = str(update.message.chat.id)
 
     # Create image
-    photo_url = plotly_utils.generate_photo_url(update,context)
-    # update.message.reply_photo(photo=open("images/fig1.png", "rb"))
-    photo = open(photo_url, "rb")
+    chart_image = plotly_utils.generate_photo(update, context)
+    photo_bytes = chart_image if chart_image is not None else plotly_utils.get_sample_image()
+    content_hash = utils.get_content_hash(photo_bytes)
+    # the sample image and repeated charts are uploaded once, then sent by file_id
+    file_id = db_utils.retrieve_file_id(content_hash)
     updated_date = utils.get_current_date()
     message = bot.send_photo(chat_id=update.message.chat.id,
-                   photo=photo,
+                   photo=file_id or io.BytesIO(photo_bytes),
                    parse_mode='Markdown',
                    caption=f"_Last updated on {updated_date}_")
+    if file_id is None:
+        db_utils.store_file_id(content_hash, message.photo[-1].file_id)
 
     chart_id = str(message.message_id)
-    perm_save_url = f"{plotly_utils.IMAGE_DESTINATION}{chat_id}_{chart_id}.png"
-    # Update photo url with message id
-    photo.close()
-    if photo_url is not plotly_utils.SAMPLE_IMAGE_URL:
-        shutil.move(photo_url, perm_save_url)
+    if chart_image is not None:
+        plotly_utils.persist_image(chart_image, chat_id, chart_id)
 
     # Store in context
     context.chat_data['chart_id'] = chart_id
@@ -283,6 +370,9 @@ def get_suggestion(update, context):
     return STORE_SUGGESTION
 
 
+@run_async
+@persist_state
+@timed
 def store_suggestion(update, context):
     context.chat_data['suggestion'] = update.message.text
     update.message.reply_markdown("Thanks for your suggestion.")
@@ -300,6 +390,9 @@ def chart(update, context):
     return CHART_COMMANDS
 
 
+@run_async
+@persist_state
+@timed
 def display_charts(update, context):
     chart_choice = update.message.text
     chat_id = str(update.message.chat.id)
@@ -329,6 +422,9 @@ def find_chart(update, context):
     return chat_id, chart_id
 
 
+@run_async
+@persist_state
+@timed
 def retrieve_chart(update, context):
     chat_id, chart_id = find_chart(update, context)
     bot.send_message(chat_id=chat_id,
@@ -338,6 +434,9 @@ def retrieve_chart(update, context):
     return ConversationHandler.END
 
 
+@run_async
+@persist_state
+@timed
 def delete_chart(update, context):
     chat_id, chart_id = find_chart(update, context)
     db_utils.delete_chart(chat_id, chart_id)
@@ -376,6 +475,95 @@ def end(update, context):
     return ConversationHandler.END
 
 
+def get_conversation_handlers(dispatcher):
+    return [handler for handler in dispatcher.handlers[0]
+            if isinstance(handler, ConversationHandler) and handler.persistent]
+
+
+def wait_for_previous_update(update, context):
+    """
+    The chat's previous update is still being handled, queue this one behind it
+    """
+    handler = get_conversation_handlers(context.dispatcher)[0]
+    key = handler._get_key(update)
+    with waiting_updates_lock:
+        if key in waiting_updates:
+            waiting_updates[key].append(update)
+            return
+        waiting_updates[key] = collections.deque([update])
+    threading.Thread(target=release_waiting_updates, args=(context.dispatcher, handler, key), daemon=True).start()
+
+
+def hold_waiting_update(update, context):
+    """
+    Queue an update behind the chat's waiting updates, so it is not handled before them
+    """
+    if not isinstance(update, telegram.Update) or update.effective_chat is None:
+        return
+    with waiting_updates_lock:
+        if update.update_id in released_updates:
+            return
+        handlers = get_conversation_handlers(context.dispatcher)
+        if not handlers:
+            return
+        key = handlers[0]._get_key(update)
+        if key in waiting_updates:
+            waiting_updates[key].append(update)
+            raise DispatcherHandlerStop()
+
+
+def mark_update_handled(update, context):
+    with waiting_updates_lock:
+        handled = released_updates.pop(getattr(update, 'update_id', None), None)
+    if handled is not None:
+        handled.set()
+
+
+def release_waiting_updates(dispatcher, handler, key):
+    """
+    Put a chat's waiting updates back on the update queue one at a time and in order, each once the
+    handler of the update before it is done
+    """
+    while True:
+        with handler._conversations_lock:
+            state = handler.conversations.get(key)
+        if isinstance(state, tuple):
+            state[1].done.wait()
+        with waiting_updates_lock:
+            queue = waiting_updates[key]
+            if not queue:
+                del waiting_updates[key]
+                return
+            update = queue.popleft()
+            handled = released_updates[update.update_id] = threading.Event()
+        dispatcher.update_queue.put(update)
+        if not handled.wait(RELEASE_TIMEOUT_SECONDS):
+            logger.error(f"BOT: Update {update.update_id} was not handled in {RELEASE_TIMEOUT_SECONDS}s")
+            with waiting_updates_lock:
+                released_updates.pop(update.update_id, None)
+
+
+def load_shared_state(update, context):
+    """
+    Load the chat's conversation state and chat_data, another bot process may have handled its last update
+    """
+    context.dispatcher.persistence.load_update_state(update, context.chat_data, context.bot,
+                                                     get_conversation_handlers(context.dispatcher))
+
+
+def log_latency_percentiles(context):
+    latencies = list(handler_latencies)
+    if len(latencies) < 2:
+        return
+    percentiles = statistics.quantiles(latencies, n=100)
+    logger.info(f"Handler latency over {len(latencies)} updates: p50 {percentiles[49]:.3f}s "
+                f"p95 {percentiles[94]:.3f}s p99 {percentiles[98]:.3f}s")
+
+
+def log_item_cache_metrics(context):
+    logger.info(f"Item cache: {shopee_utils.item_cache.get_metrics()}")
+
+
 def error(update, context):
     """Log Errors caused by Updates."""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
@@ -430,15 +618,23 @@ def context_clear(context):
     return context
 
 
-def main():
+def main(mode=UPDATE_MODE, port=WEBHOOK_PORT, workers=HANDLER_WORKERS):
     # Create the Updater and pass it your bot's token.
     # Make sure to set use_context=True to use the new context based callbacks
     # Post version 12 this will no longer be necessary
-    updater = Updater(TELEGRAM_TOKEN, use_context=True)
+    persistence = persistence_utils.MongoPersistence()
+    updater = Updater(TELEGRAM_TOKEN, use_context=True, workers=workers, persistence=persistence)
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
 
+    # keep each chat's updates in order while one of its handlers runs on the worker pool
+    dp.add_handler(TypeHandler(telegram.Update, hold_waiting_update), group=-2)
+    dp.add_handler(TypeHandler(telegram.Update, mark_update_handled), group=1)
+
+    # load what other bot processes stored for the chat before the conversation handler sees the update
+    dp.add_handler(TypeHandler(telegram.Update, load_shared_state), group=-1)
+
     # Add conversation handler with the states GENDER, PHOTO, LOCATION and BIO
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start),
@@ -477,13 +673,19 @@ def main():
 
             DELETE_CHART: [MessageHandler(Filters.text, delete_chart)],
 
-            DISPLAY_CHARTS: [MessageHandler(Filters.text, get_threshold_and_send_graph)]
+            DISPLAY_CHARTS: [MessageHandler(Filters.text, get_threshold_and_send_graph)],
+
+            ConversationHandler.WAITING: [MessageHandler(Filters.all, wait_for_previous_update)]
 
         },
 
         fallbacks=[CommandHandler('end', end)],
 
-        allow_reentry=True
+        allow_reentry=True,
+
+        name=CONVERSATION_NAME,
+
+        persistent=True
     )
 
     dp.add_handler(conv_handler)
@@ -491,8 +693,18 @@ def main():
     # log all errors
     dp.add_error_handler(error)
 
+    updater.job_queue.run_repeating(log_latency_percentiles, LATENCY_REPORT_SECONDS)
+    updater.job_queue.run_repeating(log_item_cache_metrics, LATENCY_REPORT_SECONDS)
+
     # Start the Bot
-    updater.start_polling()
+    if mode == "webhook":
+        # POST updates to http://<host>:<port>/<token>, any number of processes can serve the same url
+        updater.start_webhook(listen=WEBHOOK_LISTEN, port=port, url_path=TELEGRAM_TOKEN)
+        if WEBHOOK_URL is not None:
+            updater.bot.set_webhook(url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}", max_connections=WEBHOOK_MAX_CONNECTIONS)
+        logger.info(f"BOT: Receiving updates by webhook on port {port} with {workers} workers")
+    else:
+        updater.start_polling()
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
@@ -501,5 +713,9 @@ def main():
 
 
 if __name__ == '__main__':
+    # python bot.py [polling|webhook] [port] [workers]
     db = db_utils.db_connect("eyesontheprice")
-    main()
\ No newline at end of file
+    mode = sys.argv[1] if len(sys.argv) > 1 else UPDATE_MODE
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else WEBHOOK_PORT
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else HANDLER_WORKERS
+    main(mode, port, workers)
\ No newline at end of file
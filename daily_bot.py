@@ -5,8 +5,12 @@ from telegram.ext import Updater
 import telegram.ext
 import db_utils
 import plotly_utils
+import render_utils
+import delivery_utils
+from telegram.utils.request import Request
 import utils
 import sys
+import io
 
 
 # Enable logging
@@ -19,78 +23,153 @@ logging.basicConfig(
 logging.getLogger().addHandler(logging.StreamHandler())
 logger = logging.getLogger(__name__)
 
-bot = telegram.Bot(token=TELEGRAM_TOKEN)
+# one pooled connection per delivery worker
+bot = telegram.Bot(token=TELEGRAM_TOKEN, request=Request(con_pool_size=delivery_utils.DELIVERY_WORKERS))
 
 
-def update_charts():
+def update_charts(delivery_queue, batch_size=render_utils.RENDER_BATCH_SIZE):
     """
     Update stored charts and send them to each user
     """
     logger.info(f"Starting update_charts...")
     logger.info(f"Retrieving chart collection objects...")
-    charts = db_utils.retrieve_chart_collection()
+    # only charts holding a variant that changed in today's sweep need a new image
+    charts = db_utils.retrieve_chart_collection(db_utils.retrieve_change_set())
     logger.info(f"Retrieved chart collection objects")
-    for chart in charts:
-        if chart.chart_name is not None:
-            chart_name = chart.chart_name
-        else:
-            chart_name = "Price Change"
-        image_url, labels, current_prices, price_changes, created_dates = plotly_utils.update_image(chart.chat_id, chart.chart_id, chart_name)
-        logger.info(f"Stored chart {chart_name} {chart.chart_id} for {chart.chat_id}")
-        if image_url is not None:
-            send_chart_to_user(chart.chat_id, chart.chart_id, image_url, labels, current_prices, price_changes, created_dates)
+    pending_charts = []
+    with render_utils.RenderPool() as render_pool:
+        for chart in charts:
+            if chart.chart_name is not None:
+                chart_name = chart.chart_name
+            else:
+                chart_name = "Price Change"
+            chart_data = plotly_utils.get_chart_data(chart)
+            if chart_data is None:
+                continue
+            caption = get_caption(*plotly_utils.get_chart_summary(chart_data))
+            content_hash = plotly_utils.get_chart_hash(chart_data, chart_name, caption)
+            if content_hash == chart.content_hash:
+                logger.info(f"Chart {chart_name} {chart.chart_id} for {chart.chat_id} unchanged, skipping...")
+                continue
+            pending_charts.append((chart, chart_name, chart_data, content_hash))
+            if len(pending_charts) >= batch_size:
+                send_chart_batch(pending_charts, render_pool, delivery_queue)
+                pending_charts = []
+        send_chart_batch(pending_charts, render_pool, delivery_queue)
+        logger.info(f"Render metrics: {render_pool.get_metrics()}")
     logger.info(f"Update complete\n\n-----\n\n")
 
 
-def send_chart_to_user(chat_id, message_id, image_url, labels, current_prices, price_changes, created_dates):
+def send_chart_batch(pending_charts, render_pool, delivery_queue):
+    """
+    Render a batch of charts in the render pool, then send them through the delivery queue
+    :param pending_charts: list of (chart, chart_name, chart_data, content_hash)
+    """
+    if not pending_charts:
+        return
+    charts = [(chart_data, chart_name) for _, chart_name, chart_data, _ in pending_charts]
+    images = render_pool.render(charts)
+    deliveries = []
+    for (chart, chart_name, chart_data, content_hash), image in zip(pending_charts, images):
+        logger.info(f"Rendered chart {chart_name} {chart.chart_id} for {chart.chat_id}")
+        plotly_utils.persist_image(image, chart.chat_id, chart.chart_id)
+        labels, current_prices, price_changes, created_dates = plotly_utils.get_chart_summary(chart_data)
+        future = delivery_queue.submit(chart.chat_id, send_chart_to_user, chart.chat_id, chart.chart_id, image,
+                                       labels, current_prices, price_changes, created_dates)
+        deliveries.append((chart, content_hash, future))
+    for chart, content_hash, future in deliveries:
+        try:
+            future.result()
+            db_utils.store_chart_content_hash(chart.chat_id, chart.chart_id, content_hash)
+        except telegram.error.TelegramError as e:
+            logger.error(f"Could not update chart {chart.chart_id} for {chart.chat_id}: {e}")
+
+
+def get_caption(labels, current_prices, price_changes, created_dates):
+    # excludes the last updated date, so the caption only changes with the prices
+    caption = f"Price changes since _{created_dates[0]}_:\n\n"
+    for i, label in enumerate(labels):
+        caption += f"{label}: ${utils.format_price(current_prices[i])} *({price_changes[i]:.1f}%)*\n"
+    return caption
+
+
+def send_chart_to_user(chat_id, message_id, image, labels, current_prices, price_changes, created_dates):
     """
     :param chat_id: telegram chat_id
     :param message_id: telegram message_id
-    :param image_url: url of stored chart
+    :param image: PNG chart as bytes
     """
     current_date = utils.get_current_date()
 
-    caption = f"Price changes since _{created_dates[0]}_:\n\n"
-    for i, label in enumerate(labels):
-        caption += f"{label}: ${current_prices[i]} *({price_changes[i]:.1f}%)*\n"
+    caption = get_caption(labels, current_prices, price_changes, created_dates)
     caption += f"\n_Last updated on {current_date}_"
 
-    chart = open(image_url, "rb")
+    content_hash = utils.get_content_hash(image)
+    # send by file_id when the same image was uploaded before
+    file_id = db_utils.retrieve_file_id(content_hash)
     try:
-        bot.editMessageMedia(chat_id=chat_id,
-                             message_id=message_id,
-                             media=telegram.InputMediaPhoto(chart,
-                                                            caption=caption,
-                                                            parse_mode='Markdown'
-                                                            )
-                             )
+        try:
+            message = edit_chart_media(chat_id, message_id, file_id or io.BytesIO(image), caption)
+        except telegram.error.BadRequest as e:
+            if file_id is None or "file identifier" not in e.message.lower():
+                raise
+            # Telegram no longer knows the cached file_id, upload the image again
+            logger.info(f"Cached file_id of image {content_hash} rejected, uploading the image")
+            db_utils.delete_file_id(content_hash)
+            file_id = None
+            message = edit_chart_media(chat_id, message_id, io.BytesIO(image), caption)
         logger.info(f"Updated chart {message_id} for {chat_id}")
-    except telegram.error.BadRequest:
+        if file_id is None and isinstance(message, telegram.Message):
+            db_utils.store_file_id(content_hash, message.photo[-1].file_id)
+    except telegram.error.BadRequest as e:
+        # any other rejection fails the delivery, so the chart's content hash is not stored
+        if "message is not modified" not in e.message.lower():
+            raise
         logger.info(f"Already updated chart {message_id} for {chat_id}, skipping...")
 
 
-# todo: send notifications if price drops below threshold
-def send_notification_to_user():
+def edit_chart_media(chat_id, message_id, media, caption):
+    """
+    :param media: file_id of an uploaded image or the image as a file
+    """
+    return bot.editMessageMedia(chat_id=chat_id,
+                                message_id=message_id,
+                                media=telegram.InputMediaPhoto(media,
+                                                               caption=caption,
+                                                               parse_mode='Markdown'
+                                                               )
+                                )
+
+
+def send_notification_to_user(delivery_queue):
     logger.info(f"Starting user notification...")
     logger.info(f"Retrieving chart collection objects...")
     charts = db_utils.retrieve_charts_to_notify()
     logger.info(f"Retrieved chart collection objects")
-    text = ""
+    deliveries = []
     for chart in charts:
-        count = 0
+        futures = []
         if chart.threshold_hit == 1:
             for variant in chart.variants:
                 if variant.threshold_hit == 1:
-                    text += f"Woohoo!\n\nItem: {variant.item_name}\nSub-product: {variant.variant_name}\n"
-                    text += f"*Current Price: ${variant.current_price} ({variant.price_change_percent:.1f}%)*"
+                    text = f"Woohoo!\n\nItem: {variant.item_name}\nSub-product: {variant.variant_name}\n"
+                    text += f"*Current Price: ${utils.format_price(variant.current_price)} ({variant.price_change_percent:.1f}%)*"
                     text += f"\n\n[BUY IT NOW ON {variant.channel.upper()}]({variant.item_url})"
-                    bot.send_message(chat_id=chart.chat_id, text=text, parse_mode="Markdown")
-                    logger.info(f"Sent notification to user for chat {chart.chat_id} chart {chart.chart_id} variant {variant.variant_name}")
-                    count += 1
+                    futures.append(delivery_queue.submit(chart.chat_id, bot.send_message,
+                                                         chat_id=chart.chat_id, text=text, parse_mode="Markdown"))
+                    logger.info(f"Queued notification to user for chat {chart.chat_id} chart {chart.chart_id} variant {variant.variant_name}")
                 else:
                     logger.info(f"No update for chat {chart.chat_id} chart {chart.chart_id} variant {variant.variant_name}")
-            if count > 0:
-                db_utils.increment_notified_count(chart.chat_id, chart.chart_id)
+            if futures:
+                deliveries.append((chart, futures))
+
+    for chart, futures in deliveries:
+        try:
+            for future in futures:
+                future.result()
+            db_utils.increment_notified_count(chart.chat_id, chart.chart_id)
+        except telegram.error.TelegramError as e:
+            logger.error(f"Could not notify chat {chart.chat_id} for chart {chart.chart_id}: {e}")
     logger.info(f"User notification done.\n\n-----\n\n")
 
 
@@ -116,8 +195,9 @@ def main():
 
     # j.run_once(callback_30, 30)
     # run tasks
-    update_charts()
-    send_notification_to_user()
+    with delivery_utils.DeliveryQueue() as delivery_queue:
+        update_charts(delivery_queue)
+        send_notification_to_user(delivery_queue)
 
     updater.stop()
     # Start the Bot
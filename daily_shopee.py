@@ -11,7 +11,10 @@ import utils
 import numpy as np
 from decimal import Decimal
 import pymongo
-from mongoengine.errors import OperationError
+import itertools
+import series_utils
+from bson.binary import Binary
+from pymongo.errors import OperationFailure
 # Enable logging
 logging.basicConfig(
                     filename="logs",
@@ -24,181 +27,437 @@ logger = logging.getLogger(__name__)
 
 bot = telegram.Bot(token=TELEGRAM_TOKEN)
 
+# Append only the new days to stored series instead of rebuilding them daily
+INCREMENTAL_SERIES = True
+# Copy item variants into charts with one aggregation, falling back to bulk updates
+SERVER_SIDE_CHART_SYNC = True
+CHART_VARIANT_SYNC_FIELDS = ["current_price", "lowest_price"]
+# Fields the daily sweep reads from each variant, the series fields it needs are added by get_sweep_fields
+SWEEP_FIELDS = ["variant_id", "item_id", "shop_id", "current_price", "stock"]
+LEGACY_SERIES_FIELDS = ["created_time", "created_price", "price_history", "date_list", "price_list", "lowest_price"]
+# Fields the threshold evaluation reads from each chart
+THRESHOLD_FIELDS = ["chart_id", "chart_name", "threshold", "variants.variant_id", "variants.created_price",
+                    "variants.current_price"]
 
-def get_daily_price_and_stock():
-    variants = db_models.ItemVariant.objects()
-    logger.info(f"Working on fetching daily information for {len(variants)} variants.\n")
-    for i, variant in enumerate(variants):
-        db_price = variant.current_price
-        logger.info(f"{i+1}. {variant.variant_id}: Found db price {db_price}")
-        if variant.channel == "shopee":
-            current_price, current_stock = get_shopee_response(variant)
-            update_variant_collection(current_price, current_stock, variant, db_price, i)
 
+def get_daily_price_and_stock(max_workers=utils.FETCH_CONCURRENCY, search_link=utils.SHOPEE_SEARCH_LINK,
+                              chunk_size=db_utils.BULK_WRITE_CHUNK_SIZE, batch_size=db_utils.BATCH_READ_SIZE):
+    """
+    Fetch and store the daily price and stock of every tracked variant.
+    Variants are streamed sorted by item and handled chunk_size items at a time, so only one chunk is held in memory
+    :param batch_size: variants read from the database per round trip
+    :return: set of variant ids whose price, stock or stored series changed
+    """
+    logger.info(f"Working on fetching daily information for shopee variants.\n")
+    variants = db_utils.stream_documents(db_models.ItemVariant.objects(channel="shopee").order_by("item_id", "shop_id"),
+                                         get_sweep_fields(), batch_size, raw=False)
+    i = 0
+    item_count = 0
+    failed_count = 0
+    missing_count = 0
+    changed_variant_ids = set()
+    observation_collection = db_models.PriceObservation._get_collection()
+    with db_utils.BulkWriter(db_models.ItemVariant._get_collection(), chunk_size) as writer, \
+            db_utils.BulkWriter(observation_collection, chunk_size) as observation_writer:
+        for item_chunk in utils.get_chunks(group_variants_by_item(variants), chunk_size):
+            search_urls = [build_shopee_search_url(item_id, shop_id, search_link) for (item_id, shop_id), _ in item_chunk]
+            logger.info(f"Fetching {len(search_urls)} shopee items with {max_workers} workers")
+            item_jsons = utils.retrieve_item_details_jsons(search_urls, max_workers)
+            for ((item_id, shop_id), item_variants), item_json in zip(item_chunk, item_jsons):
+                if item_json is None:
+                    # the request failed, keep yesterday's price and stock instead of storing a missing item
+                    logger.error(f"Request failed for item {item_id} shop {shop_id}, skipping {len(item_variants)} variants")
+                    failed_count += 1
+                    i += len(item_variants)
+                    continue
+                model_prices = parse_shopee_models(item_json)
+                if not model_prices:
+                    logger.error(f"No item found for item {item_id} shop {shop_id}")
+                for variant in item_variants:
+                    db_price = variant.current_price
+                    logger.info(f"{i+1}. {variant.variant_id}: Found db price {db_price}")
+                    if int(variant.variant_id) not in model_prices:
+                        # the item or model is gone from the response, leave the stored variant untouched
+                        logger.error(f"{i+1}. {variant.variant_id}: Not found in item {item_id}, skipping")
+                        missing_count += 1
+                        i += 1
+                        continue
+                    current_price, current_stock = model_prices[int(variant.variant_id)]
+                    if update_variant_collection(current_price, current_stock, variant, db_price, i, writer,
+                                                 observation_writer=observation_writer):
+                        changed_variant_ids.add(variant.variant_id)
+                    i += 1
+            item_count += len(item_chunk)
+    logger.info(f"Fetched {item_count} shopee items for {i} variants, {failed_count} items failed, "
+                f"{missing_count} variants not found")
+    logger.info(f"Updated variants: matched {writer.matched_count}, modified {writer.modified_count}")
+    logger.info(f"{len(changed_variant_ids)} of {i} variants changed")
+    return changed_variant_ids
 
-def get_shopee_response(variant):
+
+def get_sweep_fields():
+    # only the series that update_variant_collection extends are loaded
+    if db_utils.PRICE_OBSERVATIONS and db_utils.COMPACT_PRICE_SERIES:
+        return SWEEP_FIELDS + ["price_series"]
+    if db_utils.PRICE_OBSERVATIONS:
+        return SWEEP_FIELDS
+    return SWEEP_FIELDS + LEGACY_SERIES_FIELDS
+
+
+def group_variants_by_item(variants):
+    """
+    :param variants: iterable of ItemVariant sorted by item_id and shop_id
+    :return: generator of ((item_id, shop_id), list of tracked variants of that item)
+    """
+    for item, item_variants in itertools.groupby(variants, key=lambda variant: (variant.item_id, variant.shop_id)):
+        yield item, list(item_variants)
+
+
+def build_shopee_search_url(item_id, shop_id, search_link=utils.SHOPEE_SEARCH_LINK):
     parameters = {
-        "itemid": variant.item_id,
-        "shopid": variant.shop_id
+        "itemid": item_id,
+        "shopid": shop_id
     }
-    search_url = utils.build_search_url(utils.SHOPEE_SEARCH_LINK, parameters)
-    item_json = utils.retrieve_item_details_json(search_url)
-    variant_id = int(variant.variant_id)
+    search_url = utils.build_search_url(search_link, parameters)
+    return search_url
+
+
+def parse_shopee_models(item_json):
+    """
+    Parse a Shopee item response once into the price and stock of every model
+    :param item_json: json returned by the Shopee item api
+    :return: dict of model id (or item id for items without models) to (price in cents, stock)
+    """
+    model_prices = {}
     try:
-        # logger.info(f"ITEM {variant_id} {item_json['item']['itemid']} {variant_id == item_json['item']['itemid']}")
-        if variant_id == item_json["item"]["itemid"]:
-            price = int(item_json['item']['price_min']) / shopee_utils.SHOPEE_PRICE_DENOMINATION
-            stock = item_json['item']['stock']
-            return round(price,2), stock
-        else:
-            variants = item_json['item']['models']
-            for i in variants:
-                # logger.info(f"VARIANT {variant_id} {i['modelid']} {variant_id == i['modelid']}")
-                if variant_id == int(i['modelid']):
-                    price = int(i['price']) / shopee_utils.SHOPEE_PRICE_DENOMINATION
-                    stock = i['stock']
-                    return round(price,2), stock
-    except TypeError:
-        logger.error(f"No item found for {variant.variant_id}")
-        return 0, 0
-
-
-def update_variant_collection(current_price, current_stock, variant, db_price, i):
-    date_list = get_date_list(variant.created_time)
-    price_list = get_price_list(date_list, variant)
+        item = item_json['item']
+        model_prices[int(item['itemid'])] = (shopee_utils.get_price_cents(item['price_min']), item['stock'])
+        for model in item['models'] or []:
+            model_prices[int(model['modelid'])] = (shopee_utils.get_price_cents(model['price']), model['stock'])
+    except (TypeError, KeyError):
+        return model_prices
+    return model_prices
+
+
+def update_variant_collection(current_price, current_stock, variant, db_price, i, writer, incremental=INCREMENTAL_SERIES,
+                              observation_writer=None):
+    """
+    Queue the daily update of a variant on writer
+    :param observation_writer: writer of price_observations, today's price is appended there instead of
+    to the variant's date_list and price_list when db_utils.PRICE_OBSERVATIONS is on
+    :return: True if the price, stock or the whole stored series of the variant changed
+    """
     last_updated_time = datetime.now()
+    changed = current_stock != variant.stock
 
-    if abs(current_price - float(db_price)) > 0.01:
-        price_list[-1] = current_price
-        new_price_history = {
-            "date": last_updated_time,
-            "price": current_price
-        }
-        db_models.ItemVariant.objects(variant_id=variant.variant_id).update_one(push__price_history=new_price_history,
-                                                                                set__last_updated_time=last_updated_time,
-                                                                                set__current_price=current_price,
-                                                                                set__stock=current_stock,
-                                                                                set__price_list=price_list,
-                                                                                set__date_list=date_list,
-                                                                                set__lowest_price=min(price_list),
-                                                                                upsert=True
-                                                                                )
+    update = {
+        "$set": {
+            "last_updated_time": last_updated_time,
+            "stock": current_stock,
+        },
+        "$push": {}
+    }
+    if current_price != db_price:
+        changed = True
+        series_price = current_price
+        new_price_history = db_models.Price(date=last_updated_time, price=current_price)
+        update["$push"]["price_history"] = new_price_history.to_mongo()
+        update["$set"]["current_price"] = current_price
         logger.info(f"{i+1}. {variant.variant_id}: Price changed from {db_price} to {current_price}\n")
-
     else:
-        db_models.ItemVariant.objects(variant_id=variant.variant_id).update_one(
-                                                                                set__last_updated_time=last_updated_time,
-                                                                                set__stock=current_stock,
-                                                                                set__price_list=price_list,
-                                                                                set__date_list=date_list,
-                                                                                set__lowest_price=min(price_list),
-                                                                                upsert=True
-                                                                                )
+        series_price = db_price
         logger.info(f"{i+1}. {variant.variant_id}: Price unchanged at {db_price}\n")
 
+    if db_utils.PRICE_OBSERVATIONS and observation_writer is not None:
+        observation_writer.add(db_utils.get_price_observation_update(variant.variant_id, last_updated_time,
+                                                                     series_price))
+        update["$min"] = {"lowest_price": series_price}
+        if db_utils.COMPACT_PRICE_SERIES:
+            update["$set"]["price_series"] = Binary(get_compact_series_append(
+                variant, last_updated_time.date(), series_price))
+        if not update["$push"]:
+            del update["$push"]
+        writer.add(pymongo.UpdateOne({"_id": variant.variant_id}, update))
+        return changed
+
+    series_update = None
+    if incremental:
+        series_update = get_series_append(variant, series_price, last_updated_time.date())
+        if series_update is None:
+            logger.info(f"{i+1}. {variant.variant_id}: Stored series inconsistent, rebuilding")
+
+    if series_update is not None:
+        update["$push"].update(series_update.get("$push", {}))
+        update["$set"].update(series_update.get("$set", {}))
+        update["$min"] = series_update["$min"]
+    else:
+        changed = True
+        date_list = get_date_list(variant.created_time)
+        price_list = get_price_list(date_list, variant)
+        price_list[-1] = series_price
+        price_list = [int(price) for price in price_list]
+        update["$set"]["price_list"] = price_list
+        update["$set"]["date_list"] = date_list
+        update["$set"]["lowest_price"] = min(price_list)
+
+    if not update["$push"]:
+        del update["$push"]
+    writer.add(pymongo.UpdateOne({"_id": variant.variant_id}, update))
+    return changed
+
+
+def get_compact_series_append(variant, current_date, price):
+    """
+    End the variant's compact series on current_date with price. A variant without a compact series gets one built
+    from its stored price observations first, so its chart keeps the days before today.
+    :return: bytes of the compact series
+    """
+    if variant.price_series:
+        return series_utils.append_price_series(variant.price_series, current_date, price)
+    date_list, price_list = db_utils.retrieve_price_series(
+        [variant.variant_id], end_date=current_date - timedelta(days=1)).get(variant.variant_id, ([], []))
+    logger.info(f"{variant.variant_id}: No compact series, built one from {len(date_list)} stored observations")
+    return series_utils.encode_price_series(date_list + [current_date.isoformat()], price_list + [price])
+
+
+def get_series_append(variant, price, current_date):
+    """
+    Build the update that extends the stored date_list and price_list up to current_date
+    :param variant: ItemVariant with its stored series
+    :param price: price for current_date, days in between carry the last stored price
+    :param current_date: date of the sweep
+    :return: dict with $push (or $set for a rerun on the same day) and $min clauses, or None if the stored
+    series needs a full rebuild
+    """
+    date_list = variant.date_list
+    price_list = variant.price_list
+    if not date_list or len(date_list) != len(price_list):
+        return None
+    try:
+        first_date = datetime.strptime(date_list[0], "%Y-%m-%d").date()
+        last_date = datetime.strptime(date_list[-1], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+    # the stored series must start on the created date and have one entry per day
+    if first_date != variant.created_time.date():
+        return None
+    if utils.difference_in_days(last_date, first_date) != len(date_list) - 1:
+        return None
+    new_days = utils.difference_in_days(current_date, last_date)
+    if new_days < 0:
+        return None
+    if new_days == 0:
+        # a rerun on the same day replaces the price it stored
+        return {
+            "$set": {f"price_list.{len(price_list) - 1}": int(price)},
+            "$min": {"lowest_price": int(price)},
+        }
+
+    last_price = int(price_list[-1])
+    new_dates = [(last_date + timedelta(days=d)).strftime("%Y-%m-%d") for d in range(1, new_days + 1)]
+    new_prices = [last_price] * (new_days - 1) + [int(price)]
+    lowest_price = min(new_prices)
+    # seed lowest_price for variants stored before it was tracked
+    if getattr(variant, "lowest_price", None) is None:
+        lowest_price = min(lowest_price, min(int(p) for p in price_list))
+    return {
+        "$push": {
+            "date_list": {"$each": new_dates},
+            "price_list": {"$each": new_prices},
+        },
+        "$min": {"lowest_price": lowest_price},
+    }
+
 
 def get_date_list(created_time):
-    day_diff = utils.difference_in_days(datetime.now(), created_time) + 1
-    date_list = []
-    created_date = created_time.date()
-    for i in range(day_diff):
-        dte = (created_date+timedelta(days=i)).strftime("%Y-%m-%d")
-        date_list.append(dte)
-    # print(date_list)
+    created_date = np.datetime64(created_time.date())
+    current_date = np.datetime64(utils.get_current_date())
+    date_list = np.datetime_as_string(np.arange(created_date, current_date + 1)).tolist()
     return date_list
 
 
 def get_price_list(date_list, variant):
-    price_list = np.empty(len(date_list))
-    price_list.fill(variant.created_price)
-    # logger.info(len(date_list))
-    # logger.info(date_list)
-    # logger.info(price_list)
-    start = 0
-    for i in range(len(variant.price_history)-1):
-        # logger.info(f"start: {start}, end: {end}")
-        end = start + utils.difference_in_days(variant.price_history[i+1].date, variant.price_history[i].date)
-        # logger.info(f"start: {start}, end: {end}")
-        price_list[start:end] = variant.price_history[i].price
-        # logger.info(price_list)
-        start = end
-    price_list[start:] = variant.price_history[-1].price
-    # logger.info(f"\n\n")
-    return price_list
+    history = [(price.date, price.price) for price in variant.price_history]
+    return utils.expand_price_histories([history], [len(date_list)], [variant.created_price])[0]
 
 
-def copy_chart_variants():
-    variant_collection = db_models.ItemVariant.objects()
-    logger.info(f"\nCopying {len(variant_collection)} variants from ItemVariant to ChartVariant.")
-    for i, variant in enumerate(variant_collection):
+def copy_chart_variants(changed_variant_ids=None, server_side=SERVER_SIDE_CHART_SYNC,
+                        chunk_size=db_utils.BULK_WRITE_CHUNK_SIZE, batch_size=db_utils.BATCH_READ_SIZE):
+    """
+    :param changed_variant_ids: only copy these variants, all variants if None
+    """
+    if server_side:
         try:
-            logger.info(f"Copying {i+1}. {variant.variant_id} {variant.variant_name}")
-            db_models.Chart.objects(variants__variant_id=variant.variant_id).update(set__variants__S__price_history=variant.price_history,
-                                                                                        set__variants__S__current_price=variant.current_price,
-                                                                                        set__variants__S__price_list=variant.price_list,
-                                                                                        set__variants__S__date_list=variant.date_list,
-                                                                                        set__variants__S__lowest_price=variant.lowest_price,
-                                                                                        set__variants__S__last_updated_time=datetime.now(),
-                                                                                   )
-        except OperationError:
-            logger.info(f"Cannot find variant")
-            return None
-    logger.info(f"Copied {len(variant_collection)} variants from ItemVariant to ChartVariant.")
-
-
-def update_chart_variants():
-    chart_collection = db_models.Chart.objects()
-    for i,chart in enumerate(chart_collection):
-        logger.info(f"\nUpdating {i + 1}. {chart.chart_id} {chart.chart_name}")
-        threshold = chart.threshold
-        threshold_hit = 0
-        threshold_hit_list = []
-        price_change_percent_list = []
-
-        for j, chart_variant in enumerate(chart.variants):
-            logger.info(f"Updating {i+1}.{j+1}. {chart_variant.variant_id} {chart_variant.variant_name}")
-            price_change = round(chart_variant.current_price - chart_variant.created_price,2)
-            price_change_percent = round(price_change / chart_variant.created_price, 2) * 100
-
-            if (price_change_percent < 0) & (price_change_percent < threshold) & (price_change_percent != -100):
-                threshold_hit = 1
-                logger.info(f"Updating {i+1}.{j+1}. Threshold hit for {chart_variant.variant_id} {chart_variant.variant_name}. {price_change_percent}|{threshold}")
-            else:
-                logger.info(f"Updating {i+1}.{j+1}. Threshold not hit for {chart_variant.variant_id} {chart_variant.variant_name}. {price_change_percent}|{threshold}")
-
-            threshold_hit_list.append(threshold_hit)
-            price_change_percent_list.append(price_change_percent)
-
-            db_models.Chart.objects(variants__variant_id=chart_variant.variant_id).update(
-                                        set__variants__S__price_change=chart_variant.price_change,
-                                        set__variants__S__price_change_percent=chart_variant.price_change_percent,
-                                        set__variants__S__threshold_hit=threshold_hit,
-            )
-
-        if sum(threshold_hit_list) > 0:
-            threshold_hit = 1
-            logger.info(f"Updating {i + 1}. Threshold hit for {chart.chart_id} {chart.chart_name} {threshold_hit_list}")
+            chart_collection = db_models.Chart._get_collection()
+            chart_collection.aggregate(get_chart_variant_sync_pipeline(changed_variant_ids))
+            logger.info(f"Copied variants from ItemVariant to ChartVariant with a single aggregation.")
+            return
+        except OperationFailure as e:
+            logger.error(f"Aggregation copy failed, falling back to bulk copy: {e}")
+
+    sync_fields = get_chart_variant_sync_fields()
+    variant_collection = db_models.ItemVariant._get_collection()
+    query = {}
+    if changed_variant_ids is not None:
+        query = {"_id": {"$in": list(changed_variant_ids)}}
+    logger.info(f"\nCopying variants from ItemVariant to ChartVariant.")
+    with db_utils.BulkWriter(db_models.Chart._get_collection(), chunk_size) as writer:
+        for variant in variant_collection.find(query, {field: 1 for field in sync_fields}, batch_size=batch_size):
+            update = {f"variants.$[variant].{field}": variant.get(field) for field in sync_fields}
+            update["variants.$[variant].last_updated_time"] = datetime.now()
+            writer.add(pymongo.UpdateMany({"variants._id": variant["_id"]},
+                                          {"$set": update},
+                                          array_filters=[{"variant._id": variant["_id"]}]))
+    logger.info(f"Copied variants into {writer.modified_count} of {writer.matched_count} matched charts.")
+
+
+def get_chart_variant_sync_fields():
+    # series are only duplicated into charts when charts do not read through to ItemVariant
+    if db_utils.CHART_VARIANT_READ_THROUGH:
+        return CHART_VARIANT_SYNC_FIELDS
+    return db_utils.CHART_VARIANT_SERIES_FIELDS + CHART_VARIANT_SYNC_FIELDS
+
+
+def get_chart_variant_sync_pipeline(changed_variant_ids=None):
+    """
+    Aggregation that joins every chart with its item variants and merges the copied fields back into the chart
+    :param changed_variant_ids: only sync charts holding one of these variants, all charts if None
+    """
+    synced_fields = {field: f"$$item_variant.{field}" for field in get_chart_variant_sync_fields()}
+    synced_fields["last_updated_time"] = "$$NOW"
+    chart_filter = {"variants._id": {"$exists": True}}
+    if changed_variant_ids is not None:
+        chart_filter = {"variants._id": {"$in": list(changed_variant_ids)}}
+    return [
+        {"$match": chart_filter},
+        {"$lookup": {
+            "from": db_models.ItemVariant._get_collection_name(),
+            "localField": "variants._id",
+            "foreignField": "_id",
+            "as": "item_variants",
+        }},
+        {"$project": {"variants": {"$map": {
+            "input": "$variants",
+            "as": "chart_variant",
+            "in": {"$let": {
+                "vars": {"item_variant": {"$arrayElemAt": [
+                    {"$filter": {
+                        "input": "$item_variants",
+                        "cond": {"$eq": ["$$this._id", "$$chart_variant._id"]},
+                    }}, 0]}},
+                "in": {"$cond": [
+                    {"$eq": [{"$type": "$$item_variant"}, "missing"]},
+                    "$$chart_variant",
+                    {"$mergeObjects": ["$$chart_variant", synced_fields]},
+                ]},
+            }},
+        }}}},
+        {"$merge": {
+            "into": db_models.Chart._get_collection_name(),
+            "on": "_id",
+            "whenMatched": "merge",
+            "whenNotMatched": "discard",
+        }},
+    ]
+
+
+def update_chart_variants(changed_variant_ids=None, chunk_size=db_utils.BULK_WRITE_CHUNK_SIZE,
+                          batch_size=db_utils.BATCH_READ_SIZE):
+    """
+    Evaluate the thresholds of charts streamed as raw documents, chunk_size charts at a time
+    :param changed_variant_ids: only evaluate charts holding one of these variants, all charts if None
+    :param batch_size: charts read from the database per round trip
+    """
+    charts = db_utils.stream_documents(db_utils.get_chart_query(changed_variant_ids), THRESHOLD_FIELDS, batch_size)
+    chart_count = 0
+    with db_utils.BulkWriter(db_models.Chart._get_collection(), chunk_size) as writer:
+        for chart_chunk in utils.get_chunks(charts, chunk_size):
+            update_chart_thresholds(chart_chunk, writer, chart_count)
+            chart_count += len(chart_chunk)
+    logger.info(f"Evaluated thresholds of {chart_count} charts.")
+    logger.info(f"Updated {writer.modified_count} of {writer.matched_count} charts.")
+
+
+def update_chart_thresholds(charts, writer, offset=0):
+    """
+    Queue the threshold updates of a chunk of charts on writer
+    :param charts: list of raw chart documents with the THRESHOLD_FIELDS
+    :param offset: number of charts evaluated before this chunk, for logging
+    """
+    item_variants = {}
+    if db_utils.CHART_VARIANT_READ_THROUGH:
+        variant_ids = [chart_variant["_id"] for chart in charts for chart_variant in chart.get("variants", [])]
+        item_variants = {variant_id: item_variant.current_price for variant_id, item_variant
+                         in db_utils.retrieve_item_variants(variant_ids, "current_price").items()}
+
+    current_prices = []
+    created_prices = []
+    thresholds = []
+    for chart in charts:
+        threshold = chart.get("threshold") if chart.get("threshold") is not None else -100
+        for chart_variant in chart.get("variants", []):
+            current_prices.append(item_variants.get(chart_variant["_id"], chart_variant.get("current_price")) or 0)
+            created_prices.append(chart_variant.get("created_price") or 0)
+            thresholds.append(threshold)
+    price_changes, price_change_percents, threshold_hits = get_price_changes(current_prices, created_prices, thresholds)
+
+    start = 0
+    for i, chart in enumerate(charts, offset):
+        chart_variants = chart.get("variants", [])
+        end = start + len(chart_variants)
+        threshold_hit_list = threshold_hits[start:end].tolist()
+        threshold_hit = int(any(threshold_hit_list))
+        update = {
+            "price_change_percent_list": price_change_percents[start:end].tolist(),
+            "threshold_hit_list": threshold_hit_list,
+            "threshold_hit": threshold_hit,
+        }
+        for j in range(len(chart_variants)):
+            update[f"variants.{j}.current_price"] = int(current_prices[start + j])
+            update[f"variants.{j}.price_change"] = int(price_changes[start + j])
+            update[f"variants.{j}.price_change_percent"] = float(price_change_percents[start + j])
+            update[f"variants.{j}.threshold_hit"] = threshold_hit_list[j]
+        writer.add(pymongo.UpdateOne({"_id": chart["_id"]}, {"$set": update}))
+
+        if threshold_hit:
+            logger.info(f"Updating {i + 1}. Threshold hit for {chart.get('chart_id')} {chart.get('chart_name')} {threshold_hit_list}")
         else:
-            threshold_hit = 0
-            logger.info(f"No Update {i + 1}. Threshold not hit for {chart.chart_id} {chart.chart_name} {threshold_hit_list}")
+            logger.info(f"No Update {i + 1}. Threshold not hit for {chart.get('chart_id')} {chart.get('chart_name')} {threshold_hit_list}")
+        start = end
+
 
-        db_models.Chart.objects(chart_id=chart.chart_id, chat_id=chart.chat_id).update(
-            set__price_change_percent_list=price_change_percent_list,
-            set__threshold_hit_list=threshold_hit_list,
-            set__threshold_hit=threshold_hit
-        )
+def get_price_changes(current_prices, created_prices, thresholds):
+    """
+    Compute price changes against the created price and threshold hits for many chart variants at once
+    :param current_prices: current price in cents of each chart variant
+    :param created_prices: price in cents of each chart variant when its chart was created
+    :param thresholds: negative percentage threshold of the chart of each variant
+    :return: numpy arrays of price changes in cents, price change percentages and threshold hits (0 or 1)
+    """
+    current_prices = np.asarray(current_prices, dtype=np.int64)
+    created_prices = np.asarray(created_prices, dtype=np.int64)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    price_changes = current_prices - created_prices
+    # whole percentages rounded half up, in integer arithmetic
+    divisors = np.where(created_prices != 0, 2 * created_prices, 1)
+    price_change_percents = np.where(created_prices != 0,
+                                     np.floor_divide(200 * price_changes + created_prices, divisors),
+                                     0)
+    threshold_hits = (price_change_percents < 0) & (price_change_percents < thresholds) & (price_change_percents != -100)
+    return price_changes, price_change_percents, threshold_hits.astype(int)
 
 
 def main():
     logger.info("\n--------------------\n")
     logger.info("Getting daily shopee price and stock")
-    get_daily_price_and_stock()
+    changed_variant_ids = get_daily_price_and_stock()
+    db_utils.store_change_set(changed_variant_ids)
     logger.info("\n--------------------\n")
     logger.info("Copying item variants and pasting into chart variants")
-    copy_chart_variants()
+    copy_chart_variants(changed_variant_ids)
     logger.info("\n--------------------\n")
     logger.info("Updating chart variants threshold hit")
-    update_chart_variants()
+    update_chart_variants(changed_variant_ids)
     logger.info("\n--------------------\n")
 
 
@@ -1,10 +1,15 @@
 import mongoengine
 from datetime import datetime
 
-#
+# Prices are stored as integer cents
+
+# Cached file_ids are dropped this many seconds after their upload, daily chart images rarely repeat after their day
+TELEGRAM_FILE_TTL_SECONDS = 3 * 24 * 3600
+
+
 class Price(mongoengine.EmbeddedDocument):
     date = mongoengine.DateField()
-    price = mongoengine.DecimalField()
+    price = mongoengine.IntField()
 
 
 # variants
@@ -16,24 +21,45 @@ class ItemVariant(mongoengine.DynamicDocument):
     channel = mongoengine.StringField()
     created_time = mongoengine.DateTimeField()
     last_updated_time = mongoengine.DateTimeField()
-    created_price = mongoengine.DecimalField()
-    current_price = mongoengine.DecimalField()
+    created_price = mongoengine.IntField()
+    current_price = mongoengine.IntField()
     price_history = mongoengine.EmbeddedDocumentListField(Price)
     # price_history_full = mongoengine.ListField(mongoengine.DecimalField())
     date_list = mongoengine.ListField(mongoengine.StringField())
-    price_list = mongoengine.ListField(mongoengine.DecimalField())
+    price_list = mongoengine.ListField(mongoengine.IntField())
+    # daily prices in the compact format of series_utils
+    price_series = mongoengine.BinaryField()
     currency = mongoengine.StringField()
     shop_id = mongoengine.StringField()
     stock = mongoengine.IntField()
     chat_ids = mongoengine.ListField(mongoengine.StringField())
     chart_ids = mongoengine.ListField(mongoengine.StringField())
-    price_change = mongoengine.DecimalField()
+    price_change = mongoengine.IntField()
     price_change_percent = mongoengine.FloatField()
     item_url = mongoengine.StringField()
     meta = {
         'collection': 'variants',
         'indexes': [
-            'item_id'
+            'item_id',
+            # daily sweep streams the shopee variants sorted by item
+            ('channel', 'item_id', 'shop_id')
+        ]
+    }
+
+
+# price of a variant on one day
+class PriceObservation(mongoengine.DynamicDocument):
+    variant_id = mongoengine.StringField(required=True)
+    # midnight of the day
+    date = mongoengine.DateTimeField(required=True)
+    price = mongoengine.IntField()
+    meta = {
+        'collection': 'price_observations',
+        'indexes': [
+            {
+                'fields': ['variant_id', 'date'],
+                'unique': True
+            }
         ]
     }
 
@@ -47,24 +73,18 @@ class ChartVariant(mongoengine.EmbeddedDocument):
     last_updated_time = mongoengine.DateTimeField()
     # to be replicated from ItemVariant periodically
     created_time = mongoengine.DateTimeField()
-    created_price = mongoengine.DecimalField()
-    current_price = mongoengine.DecimalField()
+    created_price = mongoengine.IntField()
+    current_price = mongoengine.IntField()
     price_history = mongoengine.EmbeddedDocumentListField(Price)
     date_list = mongoengine.ListField(mongoengine.StringField())
-    price_list = mongoengine.ListField(mongoengine.DecimalField())
+    price_list = mongoengine.ListField(mongoengine.IntField())
     currency = mongoengine.StringField()
     stock = mongoengine.IntField()
-    price_change = mongoengine.DecimalField()
+    price_change = mongoengine.IntField()
     price_change_percent = mongoengine.FloatField()
-    lowest_price = mongoengine.DecimalField()
+    lowest_price = mongoengine.IntField()
     item_url = mongoengine.StringField()
     threshold_hit = mongoengine.IntField()
-    meta = {
-        'collection': 'variants',
-        'indexes': [
-            'item_id'
-        ]
-    }
 
 
 class Chart(mongoengine.DynamicDocument):
@@ -78,13 +98,19 @@ class Chart(mongoengine.DynamicDocument):
     price_change_percent_list = mongoengine.ListField(mongoengine.DecimalField())
     threshold_hit = mongoengine.IntField()
     notified_count = mongoengine.IntField()
+    # hash of the plotted data and caption last sent to the chat
+    content_hash = mongoengine.StringField()
     meta = {
         'collection': 'charts',
         'indexes': [
             {
                 'fields': ['chat_id', 'chart_id'],
                 'unique': True
-            }
+            },
+            # daily sweep finds the charts holding a variant, stored as variants._id
+            'variants.variant_id',
+            # daily notifications
+            ('threshold_hit', 'notified_count')
         ]
     }
 
@@ -97,7 +123,7 @@ class ChatChartMessage(mongoengine.EmbeddedDocument):
     # variants = mongoengine.EmbeddedDocumentListField(ChatItemVariant)
     variants = mongoengine.ListField(mongoengine.StringField())
     threshold = mongoengine.IntField()
-    price_changes = mongoengine.ListField(mongoengine.DecimalField())
+    price_changes = mongoengine.ListField(mongoengine.IntField())
     price_changes_percent = mongoengine.ListField(mongoengine.FloatField())
     chart_name = mongoengine.StringField()
     # meta = {
@@ -125,8 +151,8 @@ class Item(mongoengine.DynamicDocument):
     item_name = mongoengine.StringField()
     item_description = mongoengine.StringField()
     channel = mongoengine.StringField()
-    price_min = mongoengine.DecimalField()
-    price_max = mongoengine.DecimalField()
+    price_min = mongoengine.IntField()
+    price_max = mongoengine.IntField()
     currency = mongoengine.StringField()
     categories = mongoengine.ListField(mongoengine.StringField())
     variant_ids = mongoengine.ListField(mongoengine.StringField())
@@ -139,6 +165,32 @@ class Item(mongoengine.DynamicDocument):
     }
 
 
+class TelegramFile(mongoengine.DynamicDocument):
+    # file_id of an image uploaded to Telegram, keyed by a hash of the image content
+    content_hash = mongoengine.StringField(required=True, primary_key=True)
+    file_id = mongoengine.StringField(required=True)
+    created_time = mongoengine.DateTimeField()
+    meta = {
+        'collection': 'telegram_files',
+        'indexes': [
+            {
+                'fields': ['created_time'],
+                'expireAfterSeconds': TELEGRAM_FILE_TTL_SECONDS
+            }
+        ]
+    }
+
+
+class ShortUrl(mongoengine.DynamicDocument):
+    # bit.ly link of a product url
+    long_url = mongoengine.StringField(required=True, primary_key=True)
+    short_url = mongoengine.StringField(required=True)
+    created_time = mongoengine.DateTimeField()
+    meta = {
+        'collection': 'short_urls'
+    }
+
+
 class Suggestion(mongoengine.DynamicDocument):
     user_id = mongoengine.StringField()
     username = mongoengine.StringField()
@@ -147,3 +199,35 @@ class Suggestion(mongoengine.DynamicDocument):
     meta = {
         'collection': 'suggestions'
     }
+
+
+class ChangeSet(mongoengine.DynamicDocument):
+    # variants whose price, stock or series changed in a daily sweep
+    created_time = mongoengine.DateTimeField()
+    variant_ids = mongoengine.ListField(mongoengine.StringField())
+    meta = {
+        'collection': 'change_sets',
+        'indexes': [
+            '-created_time'
+        ]
+    }
+
+
+class ConversationState(mongoengine.DynamicDocument):
+    # state of one chat in a named ConversationHandler, shared by every bot process
+    conversation_id = mongoengine.StringField(required=True, primary_key=True)
+    state = mongoengine.IntField()
+    updated_time = mongoengine.DateTimeField()
+    meta = {
+        'collection': 'conversations'
+    }
+
+
+class ChatData(mongoengine.DynamicDocument):
+    # pickled context.chat_data of a chat
+    chat_id = mongoengine.StringField(required=True, primary_key=True)
+    data = mongoengine.BinaryField()
+    updated_time = mongoengine.DateTimeField()
+    meta = {
+        'collection': 'chat_data'
+    }
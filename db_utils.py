@@ -1,7 +1,11 @@
 from mongoengine import connect
 from mongoengine.connection import disconnect
+from pymongo.errors import BulkWriteError
+from bson.binary import Binary
 from credentials import DB_URI
 import db_models
+import series_utils
+import pymongo
 from datetime import datetime
 import logging
 import sys
@@ -16,6 +20,19 @@ logging.basicConfig(
 logging.getLogger().addHandler(logging.StreamHandler())
 logger = logging.getLogger(__name__)
 
+BULK_WRITE_CHUNK_SIZE = 500
+# Documents fetched per round trip when the batch jobs stream a collection
+BATCH_READ_SIZE = 1000
+# Charts keep only variant references and per-chart prices, price series are read from ItemVariant
+CHART_VARIANT_READ_THROUGH = True
+CHART_VARIANT_SERIES_FIELDS = ["price_history", "price_list", "date_list"]
+# Daily prices are kept in price_observations, one document per variant and day,
+# instead of the date_list and price_list arrays on ItemVariant
+PRICE_OBSERVATIONS = True
+# With price observations on, ItemVariant also keeps its daily prices as a compact binary series,
+# so a chart reads one small field per variant instead of one observation per day
+COMPACT_PRICE_SERIES = True
+
 
 # Connect to, return database
 def db_connect(database):
@@ -23,6 +40,61 @@ def db_connect(database):
     return db
 
 
+class BulkWriter:
+    """
+    Collect pymongo write operations and flush them with bulk_write in chunks
+    """
+    def __init__(self, collection, chunk_size=BULK_WRITE_CHUNK_SIZE):
+        self.collection = collection
+        self.chunk_size = chunk_size
+        self.operations = []
+        self.matched_count = 0
+        self.modified_count = 0
+        self.upserted_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, operation):
+        self.operations.append(operation)
+        if len(self.operations) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.operations:
+            return
+        try:
+            result = self.collection.bulk_write(self.operations, ordered=False)
+            self.matched_count += result.matched_count
+            self.modified_count += result.modified_count
+            self.upserted_count += result.upserted_count
+        except BulkWriteError as e:
+            self.matched_count += e.details['nMatched']
+            self.modified_count += e.details['nModified']
+            self.upserted_count += e.details['nUpserted']
+            logger.error(f"DB: {len(e.details['writeErrors'])} of {len(self.operations)} bulk writes to {self.collection.name} failed")
+        logger.info(f"DB: Flushed {len(self.operations)} writes to {self.collection.name}, "
+                    f"matched {self.matched_count} modified {self.modified_count} so far")
+        self.operations = []
+
+
+def stream_documents(queryset, fields=None, batch_size=BATCH_READ_SIZE, raw=True):
+    """
+    Iterate a queryset batch_size documents per round trip, without keeping them in the queryset cache
+    :param fields: fields to load, all fields if None
+    :param raw: yield raw dicts keyed by database field names instead of documents
+    """
+    queryset = queryset.no_cache().batch_size(batch_size)
+    if fields:
+        queryset = queryset.only(*fields)
+    if raw:
+        queryset = queryset.as_pymongo()
+    return queryset
+
+
 def add_item(dict):
     item = db_models.Item(**dict)
     item.save()
@@ -46,9 +118,14 @@ def add_item_variant(item_variant_dict, context):
             # add creation time
             item_variant_dict['created_time'] = datetime.now()
             item_variant_dict['item_url'] = context.chat_data["item_url"]
+            if PRICE_OBSERVATIONS and COMPACT_PRICE_SERIES:
+                item_variant_dict['price_series'] = series_utils.encode_price_series(
+                    [datetime.now().date()], [item_variant_dict['current_price']])
 
             item_variant = db_models.ItemVariant(**item_variant_dict)
             item_variant.save()
+            if PRICE_OBSERVATIONS:
+                store_price_observations([(item_variant.variant_id, datetime.now(), item_variant.current_price)])
             logger.info(f"Bot saved new item variant in DB: {item_variant_dict['variant_id']}")
         # if variant exists, add chat id
         else:
@@ -213,10 +290,101 @@ def store_in_db_suggestion(context):
     logger.info(f"DB: Completed DB operation.")
 
 
-def retrieve_chart_collection():
-    charts = db_models.Chart.objects
-    logger.info(f"{len(charts)} charts to update...")
-    return charts
+def get_chart_query(variant_ids=None):
+    """
+    :param variant_ids: only match charts holding one of these variants, all charts if None
+    """
+    if variant_ids is None:
+        return db_models.Chart.objects
+    return db_models.Chart.objects(variants__variant_id__in=list(variant_ids))
+
+
+def retrieve_chart_collection(variant_ids=None, batch_size=BATCH_READ_SIZE):
+    """
+    :param variant_ids: only retrieve charts holding one of these variants, all charts if None
+    :return: charts streamed from the database, iterable once
+    """
+    logger.info(f"Streaming charts to update...")
+    return stream_documents(get_chart_query(variant_ids), batch_size=batch_size, raw=False)
+
+
+def store_change_set(variant_ids):
+    change_set = db_models.ChangeSet(created_time=datetime.now(), variant_ids=list(variant_ids))
+    change_set.save()
+    logger.info(f"DB: Change set of {len(variant_ids)} variants stored")
+
+
+def retrieve_change_set():
+    """
+    :return: set of variant ids changed by today's daily sweep, None if the sweep has not stored one today
+    """
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    change_set = db_models.ChangeSet.objects(created_time__gte=today).order_by('-created_time').first()
+    if change_set is None:
+        logger.info(f"DB: No change set stored today")
+        return None
+    return set(change_set.variant_ids)
+
+
+def retrieve_item_variants(variant_ids, *fields):
+    """
+    Fetch the item variants behind chart variants in one query
+    :param variant_ids: iterable of variant ids
+    :param fields: optional fields to load, all fields if empty
+    :return: dict of variant_id to ItemVariant
+    """
+    item_variants = db_models.ItemVariant.objects(variant_id__in=list(set(variant_ids)))
+    if fields:
+        item_variants = item_variants.only(*fields)
+    return {item_variant.variant_id: item_variant for item_variant in item_variants}
+
+
+def get_price_observation_update(variant_id, date, price):
+    """
+    :param date: date or datetime of the observation, stored as midnight of its day
+    :param price: price in cents
+    :return: upsert of the variant's price on that day
+    """
+    day = datetime(date.year, date.month, date.day)
+    return pymongo.UpdateOne({"variant_id": variant_id, "date": day},
+                             {"$set": {"price": int(price)}},
+                             upsert=True)
+
+
+def store_price_observations(observations, chunk_size=BULK_WRITE_CHUNK_SIZE):
+    """
+    :param observations: iterable of (variant_id, date, price)
+    """
+    with BulkWriter(db_models.PriceObservation._get_collection(), chunk_size) as writer:
+        for variant_id, date, price in observations:
+            writer.add(get_price_observation_update(variant_id, date, price))
+
+
+def retrieve_price_series(variant_ids, start_date=None, end_date=None):
+    """
+    Read the daily prices of many variants with one range query
+    :param start_date: first day to read, from the first observation if None
+    :param end_date: last day to read, up to the last observation if None
+    :return: dict of variant_id to (date_list, price_list) in date order, for variants with observations
+    """
+    query = {"variant_id": {"$in": list(set(variant_ids))}}
+    if start_date is not None or end_date is not None:
+        query["date"] = {}
+        if start_date is not None:
+            query["date"]["$gte"] = datetime(start_date.year, start_date.month, start_date.day)
+        if end_date is not None:
+            query["date"]["$lte"] = datetime(end_date.year, end_date.month, end_date.day)
+    observations = db_models.PriceObservation._get_collection().find(
+        query, {"_id": 0, "variant_id": 1, "date": 1, "price": 1}).sort([("variant_id", 1), ("date", 1)])
+
+    # prices as the model field reads them
+    price_field = db_models.PriceObservation._fields["price"]
+    series = {}
+    for observation in observations:
+        date_list, price_list = series.setdefault(observation["variant_id"], ([], []))
+        date_list.append(observation["date"].strftime("%Y-%m-%d"))
+        price_list.append(price_field.to_python(observation["price"]))
+    return series
 
 
 def retrieve_charts_to_notify():
@@ -231,6 +399,98 @@ def increment_notified_count(chat_id, chart_id):
     logger.info(f"Incremented notified count for chat {chat_id} chart {chart_id}")
 
 
+def store_chart_content_hash(chat_id, chart_id, content_hash):
+    db_models.Chart.objects(chat_id=chat_id, chart_id=chart_id).update_one(set__content_hash=content_hash)
+    logger.info(f"Stored content hash for chat {chat_id} chart {chart_id}")
+
+
+def retrieve_file_id(content_hash):
+    telegram_file = db_models.TelegramFile.objects(content_hash=content_hash).first()
+    if telegram_file is None:
+        return None
+    return telegram_file.file_id
+
+
+def store_file_id(content_hash, file_id):
+    db_models.TelegramFile.objects(content_hash=content_hash).upsert_one(set__file_id=file_id,
+                                                                          set__created_time=datetime.now())
+    logger.info(f"DB: Stored file_id for image {content_hash}")
+
+
+def delete_file_id(content_hash):
+    db_models.TelegramFile.objects(content_hash=content_hash).delete()
+    logger.info(f"DB: Deleted file_id for image {content_hash}")
+
+
+def retrieve_short_urls(long_urls):
+    """
+    :return: dict of long url to stored short url, for the urls that have one
+    """
+    short_urls = db_models.ShortUrl.objects(long_url__in=list(set(long_urls)))
+    return {short_url.long_url: short_url.short_url for short_url in short_urls}
+
+
+def store_short_urls(short_urls):
+    """
+    :param short_urls: dict of long url to short url
+    """
+    with BulkWriter(db_models.ShortUrl._get_collection()) as writer:
+        for long_url, short_url in short_urls.items():
+            writer.add(pymongo.UpdateOne({"_id": long_url},
+                                         {"$set": {"short_url": short_url, "created_time": datetime.now()}},
+                                         upsert=True))
+
+
+def get_conversation_id(name, key):
+    return ":".join([name] + [str(i) for i in key])
+
+
+def retrieve_conversation_state(name, key):
+    """
+    :return: stored state of the conversation, None if it has ended or never started
+    """
+    conversation = db_models.ConversationState.objects(conversation_id=get_conversation_id(name, key)).first()
+    if conversation is None:
+        return None
+    return conversation.state
+
+
+def store_conversation_states(states, chunk_size=BULK_WRITE_CHUNK_SIZE):
+    """
+    :param states: dict of (name, key) to new state, None to end the conversation
+    """
+    with BulkWriter(db_models.ConversationState._get_collection(), chunk_size) as writer:
+        for (name, key), state in states.items():
+            conversation_filter = {"_id": get_conversation_id(name, key)}
+            if state is None:
+                writer.add(pymongo.DeleteOne(conversation_filter))
+            else:
+                writer.add(pymongo.UpdateOne(conversation_filter,
+                                             {"$set": {"state": state, "updated_time": datetime.now()}},
+                                             upsert=True))
+
+
+def retrieve_chat_data(chat_id):
+    """
+    :return: pickled chat_data, None if the chat has none stored
+    """
+    chat_data = db_models.ChatData.objects(chat_id=str(chat_id)).first()
+    if chat_data is None:
+        return None
+    return chat_data.data
+
+
+def store_chat_data(chat_data, chunk_size=BULK_WRITE_CHUNK_SIZE):
+    """
+    :param chat_data: dict of chat_id to pickled chat_data
+    """
+    with BulkWriter(db_models.ChatData._get_collection(), chunk_size) as writer:
+        for chat_id, data in chat_data.items():
+            writer.add(pymongo.UpdateOne({"_id": str(chat_id)},
+                                         {"$set": {"data": Binary(data), "updated_time": datetime.now()}},
+                                         upsert=True))
+
+
 def get_chart_names(chat_id):
     chart_messages = db_models.Chat.objects.get(chat_id=chat_id).chart_messages
     chart_names = [i.chart_name for i in chart_messages]
@@ -0,0 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+import telegram.error
+import threading
+import heapq
+import logging
+import time
+
+DELIVERY_WORKERS = 8
+# Telegram allows about 30 messages per second overall and 1 per second in a single chat
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 1
+
+# Enable logging
+logging.basicConfig(
+                    filename="logs",
+                    filemode='a',
+                    format='%(asctime)s - %(module)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO,
+                    )
+logging.getLogger().addHandler(logging.StreamHandler())
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, acquire blocks until a token is available
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_time) * self.rate)
+                self.updated_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Delivery:
+    """
+    One queued Bot API call and the future of its result
+    """
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempt = 0
+
+
+class DeliveryQueue:
+    """
+    Send Bot API calls from a pool of workers within Telegram's global and per-chat rate limits.
+    Each chat has its own queue with at most one call running or scheduled, the next call of a chat
+    is scheduled when the previous one finished. Waits for the per-chat rate, RetryAfter and backoff
+    are kept by a scheduler thread, so a worker is only busy while a call is being sent.
+    """
+    def __init__(self, workers=DELIVERY_WORKERS, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE,
+                 max_retries=MAX_RETRIES, backoff_seconds=BACKOFF_SECONDS):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_interval = 1 / chat_rate
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        # chat_id to the deque of its pending deliveries, the first one is running or scheduled
+        self.chat_queues = {}
+        # chat_id to the monotonic time its next call may be sent
+        self.chat_ready_times = {}
+        # heap of (ready time, sequence, chat_id) waiting to be handed to a worker
+        self.scheduled = []
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.closing = False
+        self.sent_count = 0
+        self.retry_count = 0
+        self.failed_count = 0
+        self.scheduler = threading.Thread(target=self.run_scheduler, daemon=True)
+        self.scheduler.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, chat_id, method, /, *args, **kwargs):
+        """
+        Queue method(*args, **kwargs) for delivery to chat_id, kwargs may hold a chat_id of their own
+        :return: future of the method's result
+        """
+        delivery = Delivery(method, args, kwargs)
+        with self.lock:
+            queue = self.chat_queues.get(chat_id)
+            if queue is None:
+                # nothing of this chat is running, start on it right away
+                self.chat_queues[chat_id] = deque([delivery])
+                self.schedule(chat_id)
+            else:
+                queue.append(delivery)
+        return delivery.future
+
+    def schedule(self, chat_id):
+        # hold self.lock
+        ready_time = self.chat_ready_times.get(chat_id, 0)
+        if ready_time <= time.monotonic():
+            self.executor.submit(self.deliver, chat_id)
+            return
+        self.sequence += 1
+        heapq.heappush(self.scheduled, (ready_time, self.sequence, chat_id))
+        self.changed.notify_all()
+
+    def run_scheduler(self):
+        with self.lock:
+            while not (self.closing and not self.scheduled):
+                if not self.scheduled:
+                    self.changed.wait()
+                    continue
+                wait = self.scheduled[0][0] - time.monotonic()
+                if wait > 0:
+                    self.changed.wait(wait)
+                    continue
+                _, _, chat_id = heapq.heappop(self.scheduled)
+                self.executor.submit(self.deliver, chat_id)
+
+    def deliver(self, chat_id):
+        with self.lock:
+            delivery = self.chat_queues[chat_id][0]
+        # a retried call is already running
+        if delivery.attempt == 0 and not delivery.future.set_running_or_notify_cancel():
+            self.finish(chat_id, 0)
+            return
+        self.global_bucket.acquire()
+        sent_time = time.monotonic()
+        try:
+            result = delivery.method(*delivery.args, **delivery.kwargs)
+        except telegram.error.RetryAfter as e:
+            logger.info(f"Rate limited on chat {chat_id}, retrying after {e.retry_after}s")
+            self.retry(chat_id, delivery, e, e.retry_after)
+        except telegram.error.BadRequest as e:
+            self.fail(chat_id, delivery, e)
+        except (telegram.error.TimedOut, telegram.error.NetworkError) as e:
+            logger.info(f"Delivery to chat {chat_id} failed with {e}, attempt {delivery.attempt + 1}")
+            self.retry(chat_id, delivery, e, self.backoff_seconds * 2 ** delivery.attempt)
+        except Exception as e:
+            self.fail(chat_id, delivery, e)
+        else:
+            self.count('sent_count')
+            delivery.future.set_result(result)
+            self.finish(chat_id, sent_time + self.chat_interval)
+
+    def retry(self, chat_id, delivery, error, wait):
+        if delivery.attempt == self.max_retries:
+            self.fail(chat_id, delivery, telegram.error.TelegramError(
+                f"Delivery to chat {chat_id} failed after {self.max_retries} retries: {error}"))
+            return
+        delivery.attempt += 1
+        self.count('retry_count')
+        with self.lock:
+            # the same call stays first in the chat's queue
+            self.chat_ready_times[chat_id] = time.monotonic() + wait
+            self.schedule(chat_id)
+
+    def fail(self, chat_id, delivery, error):
+        self.count('failed_count')
+        delivery.future.set_exception(error)
+        self.finish(chat_id, time.monotonic() + self.chat_interval)
+
+    def finish(self, chat_id, ready_time):
+        with self.lock:
+            queue = self.chat_queues[chat_id]
+            queue.popleft()
+            self.chat_ready_times[chat_id] = ready_time
+            if queue:
+                self.schedule(chat_id)
+            else:
+                del self.chat_queues[chat_id]
+                self.changed.notify_all()
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get_metrics(self):
+        return {
+            'sent_count': self.sent_count,
+            'retry_count': self.retry_count,
+            'failed_count': self.failed_count,
+        }
+
+    def close(self):
+        """
+        Wait for every queued call to be delivered or to fail, then stop the workers
+        """
+        with self.lock:
+            while self.chat_queues:
+                self.changed.wait()
+            self.closing = True
+            self.changed.notify_all()
+        self.scheduler.join()
+        self.executor.shutdown(wait=True)
+        logger.info(f"Delivery queue closed: {self.get_metrics()}")
@@ -0,0 +1,171 @@
+import db_utils
+import db_models
+import series_utils
+import pymongo
+from bson.binary import Binary
+from datetime import datetime
+import logging
+import sys
+
+# Enable logging
+logging.basicConfig(
+                    filename="logs",
+                    filemode='a',
+                    format='%(asctime)s - %(module)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO,
+                    )
+logging.getLogger().addHandler(logging.StreamHandler())
+logger = logging.getLogger(__name__)
+
+
+def migrate_chart_variants_to_references():
+    """
+    Drop the price series duplicated into chart variants, charts read them through from ItemVariant
+    """
+    logger.info(f"Removing {db_utils.CHART_VARIANT_SERIES_FIELDS} from chart variants...")
+    result = db_models.Chart._get_collection().update_many(
+        {"variants.0": {"$exists": True}},
+        {"$unset": {f"variants.$[].{field}": "" for field in db_utils.CHART_VARIANT_SERIES_FIELDS}}
+    )
+    logger.info(f"Migrated {result.modified_count} of {result.matched_count} charts to variant references.")
+
+
+def migrate_price_series_to_observations(chunk_size=db_utils.BULK_WRITE_CHUNK_SIZE):
+    """
+    Move the date_list and price_list arrays of item variants into price_observations, prices must be in cents
+    """
+    if refuse_dollar_prices("price_observations", [db_models.ItemVariant]):
+        return
+    variant_collection = db_models.ItemVariant._get_collection()
+    variants = variant_collection.find({"date_list.0": {"$exists": True}}, {"date_list": 1, "price_list": 1})
+    observation_count = 0
+    with db_utils.BulkWriter(db_models.PriceObservation._get_collection(), chunk_size) as writer:
+        for variant in variants:
+            for date, price in zip(variant["date_list"], variant.get("price_list", [])):
+                writer.add(db_utils.get_price_observation_update(variant["_id"], datetime.strptime(date, "%Y-%m-%d"),
+                                                                 price))
+                observation_count += 1
+    stored_count = writer.matched_count + writer.upserted_count
+    if stored_count != observation_count:
+        # keep the arrays so the migration can be run again
+        logger.error(f"Stored {stored_count} of {observation_count} price observations, keeping the arrays.")
+        return
+
+    result = variant_collection.update_many({"date_list": {"$exists": True}},
+                                            {"$unset": {"date_list": "", "price_list": ""}})
+    logger.info(f"Migrated {observation_count} price observations from {result.modified_count} item variants.")
+
+
+def migrate_price_observations_to_compact_series(chunk_size=db_utils.BULK_WRITE_CHUNK_SIZE):
+    """
+    Build the compact price series of every item variant from its price observations, prices must be in cents
+    """
+    if refuse_dollar_prices("compact_price_series", [db_models.PriceObservation]):
+        return
+    variant_collection = db_models.ItemVariant._get_collection()
+    variant_ids = [variant["_id"] for variant in variant_collection.find({}, {"_id": 1})]
+    with db_utils.BulkWriter(variant_collection, chunk_size) as writer:
+        for start in range(0, len(variant_ids), chunk_size):
+            price_series = db_utils.retrieve_price_series(variant_ids[start:start + chunk_size])
+            for variant_id, (date_list, price_list) in price_series.items():
+                series = series_utils.encode_price_series(date_list, price_list)
+                writer.add(pymongo.UpdateOne({"_id": variant_id}, {"$set": {"price_series": Binary(series)}}))
+    logger.info(f"Built compact price series for {writer.matched_count} of {len(variant_ids)} item variants.")
+
+
+# collections whose prices are converted to cents: price fields, price arrays, and arrays of
+# embedded documents with their price fields
+CENTS_FIELDS = [
+    (db_models.ItemVariant, ["created_price", "current_price", "lowest_price", "price_change"], ["price_list"],
+     {"price_history": ["price"]}),
+    (db_models.Chart, [], [], {"variants": ["created_price", "current_price", "lowest_price", "price_change"]}),
+    (db_models.Item, ["price_min", "price_max"], [], {}),
+    (db_models.PriceObservation, ["price"], [], {}),
+]
+DOLLAR_TYPES = ["double", "decimal"]
+
+
+def to_cents(expression):
+    return {"$toInt": {"$round": [{"$multiply": [expression, 100]}, 0]}}
+
+
+def migrate_prices_to_cents():
+    """
+    Convert dollar prices stored as doubles to integer cents, documents already in cents are left alone
+    """
+    for model, fields, arrays, embedded in CENTS_FIELDS:
+        collection = model._get_collection()
+        for field in fields:
+            result = collection.update_many({field: {"$type": DOLLAR_TYPES}},
+                                            [{"$set": {field: to_cents(f"${field}")}}])
+            logger.info(f"{collection.name}.{field}: converted {result.modified_count} documents to cents")
+        for field in arrays:
+            result = collection.update_many(
+                {field: {"$type": DOLLAR_TYPES}},
+                [{"$set": {field: {"$map": {"input": f"${field}", "in": {"$cond": [
+                    {"$in": [{"$type": "$$this"}, DOLLAR_TYPES]}, to_cents("$$this"), "$$this"]}}}}}])
+            logger.info(f"{collection.name}.{field}: converted {result.modified_count} documents to cents")
+        for field, embedded_fields in embedded.items():
+            for embedded_field in embedded_fields:
+                # converted one embedded field at a time, so the filter still finds documents left to convert
+                result = collection.update_many(
+                    {f"{field}.{embedded_field}": {"$type": DOLLAR_TYPES}},
+                    [{"$set": {field: {"$map": {"input": f"${field}", "in": {"$mergeObjects": [
+                        "$$this",
+                        {"$cond": [{"$in": [{"$type": f"$$this.{embedded_field}"}, DOLLAR_TYPES]},
+                                   {embedded_field: to_cents(f"$$this.{embedded_field}")},
+                                   {}]},
+                    ]}}}}}])
+                logger.info(f"{collection.name}.{field}.{embedded_field}: converted {result.modified_count} "
+                            f"documents to cents")
+
+
+def find_dollar_prices(models):
+    """
+    :param models: models of CENTS_FIELDS to check
+    :return: names of the price fields of models that still hold dollar doubles or decimals
+    """
+    dollar_fields = []
+    for model, fields, arrays, embedded in CENTS_FIELDS:
+        if model not in models:
+            continue
+        collection = model._get_collection()
+        paths = fields + arrays + [f"{field}.{embedded_field}" for field, embedded_fields in embedded.items()
+                                   for embedded_field in embedded_fields]
+        for path in paths:
+            if collection.find_one({path: {"$type": DOLLAR_TYPES}}, {"_id": 1}) is not None:
+                dollar_fields.append(f"{collection.name}.{path}")
+    return dollar_fields
+
+
+def refuse_dollar_prices(name, models):
+    """
+    Migrations after integer_cents cast prices to int, a dollar double like 19.99 would be stored as 19
+    :return: True if models still hold dollar prices and the migration must not run
+    """
+    dollar_fields = find_dollar_prices(models)
+    if dollar_fields:
+        logger.error(f"Not running {name}, {dollar_fields} still hold dollar prices. Run integer_cents first.")
+    return bool(dollar_fields)
+
+
+# in the order they have to run, main runs the migrations it is given in this order
+MIGRATIONS = {
+    "chart_variant_references": migrate_chart_variants_to_references,
+    "integer_cents": migrate_prices_to_cents,
+    "price_observations": migrate_price_series_to_observations,
+    "compact_price_series": migrate_price_observations_to_compact_series,
+}
+
+
+def main(names):
+    for name in sorted(names, key=list(MIGRATIONS).index):
+        logger.info(f"Running migration {name}")
+        MIGRATIONS[name]()
+
+
+if __name__ == '__main__':
+    db = db_utils.db_connect("eyesontheprice")
+    main(sys.argv[1:])
+    db.close()
+    sys.exit()
@@ -0,0 +1,242 @@
+from telegram.ext import BasePersistence
+from collections import defaultdict
+import db_utils
+import telegram
+import threading
+import hashlib
+import logging
+import pickle
+import io
+
+# Enable logging
+logging.basicConfig(
+                    filename="logs",
+                    filemode='a',
+                    format='%(asctime)s - %(module)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO,
+                    )
+logging.getLogger().addHandler(logging.StreamHandler())
+logger = logging.getLogger(__name__)
+
+# Seconds that changed chat_data and conversation states are held before they are written together,
+# 0 to write each change as it happens
+WRITE_BEHIND_SECONDS = 1.0
+
+
+class ChatDataPickler(pickle.Pickler):
+    """
+    Pickle chat_data without the Bot that telegram objects such as User refer to
+    """
+    def persistent_id(self, obj):
+        if isinstance(obj, telegram.Bot):
+            return "bot"
+        return None
+
+
+class ChatDataUnpickler(pickle.Unpickler):
+    """
+    Unpickle chat_data, giving telegram objects the bot of this process
+    """
+    def __init__(self, file, bot):
+        super().__init__(file)
+        self.bot = bot
+
+    def persistent_load(self, pid):
+        return self.bot
+
+
+def dump_chat_data(chat_data):
+    data = io.BytesIO()
+    ChatDataPickler(data).dump(dict(chat_data))
+    return data.getvalue()
+
+
+def load_chat_data(data, bot):
+    return ChatDataUnpickler(io.BytesIO(data), bot).load()
+
+
+EMPTY_CHAT_DATA_HASH = hashlib.sha1(dump_chat_data({})).digest()
+
+
+class MongoPersistence(BasePersistence):
+    """
+    Keep conversation states and chat_data in MongoDB so that any bot process can handle any chat.
+    Nothing is loaded up front, call load_update_state before each update is handled to pick up
+    what other processes stored for its chat.
+    A new conversation state is written right away together with its chat's chat_data, as is a chat
+    passed to write_chat, so the chat's next update finds them whichever process it reaches.
+    The chat_data updates the dispatcher reports after every update are held back and flushed together
+    every write_behind_seconds, only chats whose chat_data changed since it was last loaded or stored are written.
+    """
+    def __init__(self, write_behind_seconds=WRITE_BEHIND_SECONDS):
+        super().__init__(store_user_data=False, store_chat_data=True, store_bot_data=False)
+        self.write_behind_seconds = write_behind_seconds
+        # the dispatcher's chat_data, kept to write a chat's chat_data along with its conversation state
+        self.chat_data = defaultdict(dict)
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        # chat_id to the chat_data dict, pickled when it is flushed
+        self.dirty_chat_data = {}
+        # (name, key) to the new conversation state
+        self.dirty_conversations = {}
+        # what the database holds, to skip writes that change nothing
+        self.chat_data_hashes = {}
+        self.conversation_states = {}
+        self.flushed_count = 0
+        self.skipped_count = 0
+        self.stopped = threading.Event()
+        self.flush_thread = None
+        if write_behind_seconds:
+            self.flush_thread = threading.Thread(target=self.flush_periodically, daemon=True)
+            self.flush_thread.start()
+
+    def get_user_data(self):
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return self.chat_data
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return {}
+
+    def update_conversation(self, name, key, new_state):
+        if isinstance(new_state, tuple):
+            # a run_async handler is still running, its result is stored when it finishes
+            return
+        with self.lock:
+            self.dirty_conversations[(name, key)] = new_state
+        self.write_chat(key[0])
+
+    def update_chat_data(self, chat_id, data):
+        with self.lock:
+            self.dirty_chat_data[chat_id] = data
+        if not self.write_behind_seconds:
+            self.write()
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush_periodically(self):
+        while not self.stopped.wait(self.write_behind_seconds):
+            try:
+                self.write()
+            except Exception as e:
+                logger.error(f"PERSISTENCE: Write behind failed: {e}")
+
+    def write(self):
+        """
+        Store the chat_data and conversation states that changed since they were last stored
+        """
+        with self.lock:
+            dirty_chat_data, self.dirty_chat_data = self.dirty_chat_data, {}
+            dirty_conversations, self.dirty_conversations = self.dirty_conversations, {}
+        self.store(dirty_chat_data, dirty_conversations)
+
+    def write_chat(self, chat_id):
+        """
+        Store a chat's chat_data and conversation states now instead of with the next flush
+        """
+        with self.lock:
+            self.dirty_chat_data.pop(chat_id, None)
+            dirty_conversations = {conversation: state for conversation, state in self.dirty_conversations.items()
+                                   if conversation[1][0] == chat_id}
+            for conversation in dirty_conversations:
+                del self.dirty_conversations[conversation]
+        dirty_chat_data = {chat_id: self.chat_data[chat_id]} if chat_id in self.chat_data else {}
+        self.store(dirty_chat_data, dirty_conversations)
+
+    def store(self, dirty_chat_data, dirty_conversations):
+        """
+        Write the given chat_data and conversation states that differ from what the database holds
+        :param dirty_chat_data: dict of chat_id to chat_data
+        :param dirty_conversations: dict of (name, key) to conversation state
+        """
+        dumped_chat_data = {}
+        for chat_id, data in dirty_chat_data.items():
+            try:
+                dumped_chat_data[chat_id] = dump_chat_data(data)
+            except RuntimeError:
+                # a handler is changing this chat_data right now, store it on the next flush
+                with self.lock:
+                    self.dirty_chat_data.setdefault(chat_id, data)
+        chat_data_hashes = {chat_id: hashlib.sha1(data).digest() for chat_id, data in dumped_chat_data.items()}
+
+        with self.write_lock:
+            chat_data = {chat_id: data for chat_id, data in dumped_chat_data.items()
+                         if self.chat_data_hashes.get(chat_id) != chat_data_hashes[chat_id]}
+            conversations = {conversation: state for conversation, state in dirty_conversations.items()
+                             if conversation not in self.conversation_states
+                             or self.conversation_states[conversation] != state}
+            if chat_data:
+                db_utils.store_chat_data(chat_data)
+            if conversations:
+                db_utils.store_conversation_states(conversations)
+            self.chat_data_hashes.update({chat_id: chat_data_hashes[chat_id] for chat_id in chat_data})
+            self.conversation_states.update(conversations)
+
+            written_count = len(chat_data) + len(conversations)
+            self.flushed_count += written_count
+            self.skipped_count += len(dumped_chat_data) + len(dirty_conversations) - written_count
+
+    def flush(self):
+        self.stopped.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+        self.write()
+        logger.info(f"PERSISTENCE: Flushed {self.flushed_count} writes, skipped {self.skipped_count} unchanged")
+
+    def has_unstored_changes(self, chat_id, chat_data):
+        """
+        :return: True if chat_data differs from what this process last loaded or stored for the chat
+        """
+        try:
+            data_hash = hashlib.sha1(dump_chat_data(chat_data)).digest()
+        except RuntimeError:
+            # a handler is changing it right now
+            return True
+        return data_hash != self.chat_data_hashes.get(chat_id, EMPTY_CHAT_DATA_HASH)
+
+    def load_update_state(self, update, chat_data, bot, conversation_handlers):
+        """
+        Replace this process' chat_data and conversation states for the update's chat with the stored ones
+        :param chat_data: chat_data of the update's chat, updated in place
+        :param conversation_handlers: persistent ConversationHandlers to load the state of
+        """
+        if update.effective_chat is None or update.effective_user is None:
+            return
+        chat_id = update.effective_chat.id
+        for handler in conversation_handlers:
+            with handler._conversations_lock:
+                if isinstance(handler.conversations.get(handler._get_key(update)), tuple):
+                    # this process is still running a handler for the chat, its chat_data and state are newer
+                    return
+        with self.lock:
+            dirty_conversations = set(self.dirty_conversations)
+
+        # this process' own chat_data changes that are not stored yet are newer than the stored ones
+        if not self.has_unstored_changes(chat_id, chat_data):
+            data = db_utils.retrieve_chat_data(chat_id)
+            if data is not None:
+                chat_data.clear()
+                chat_data.update(load_chat_data(data, bot))
+                self.chat_data_hashes[chat_id] = hashlib.sha1(data).digest()
+
+        for handler in conversation_handlers:
+            key = handler._get_key(update)
+            if (handler.name, key) in dirty_conversations:
+                continue
+            with handler._conversations_lock:
+                if isinstance(handler.conversations.get(key), tuple):
+                    continue
+                state = db_utils.retrieve_conversation_state(handler.name, key)
+                self.conversation_states[(handler.name, key)] = state
+                if state is None:
+                    handler.conversations.pop(key, None)
+                else:
+                    handler.conversations[key] = state
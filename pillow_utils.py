@@ -0,0 +1,103 @@
+from PIL import Image, ImageDraw, ImageFont
+from datetime import datetime
+import logging
+import string
+
+WIDTH = 500
+HEIGHT = 500
+# plot area, matching the margins and legend position of plotly_utils.plot
+PLOT_LEFT = 50
+PLOT_RIGHT = 400
+PLOT_TOP = 50
+PLOT_BOTTOM = 330
+PLOT_BACKGROUND = "#E5ECF6"
+LINE_COLOURS = ["#636EFA", "#EF553B", "#00CC96", "#AB63FA", "#FFA15A",
+                "#19D3F3", "#FF6692", "#B6E880", "#FF97FF", "#FECB52"]
+FONT_PATH = "DejaVuSans.ttf"
+
+# Enable logging
+logging.basicConfig(
+                    filename="logs",
+                    filemode='a',
+                    format='%(asctime)s - %(module)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO,
+                    )
+logging.getLogger().addHandler(logging.StreamHandler())
+logger = logging.getLogger(__name__)
+
+
+def get_font(size):
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+
+def plot(date_lists, price_lists, variants, items, chart_name='Price Change'):
+    """
+    Draw the same line chart as plotly_utils.plot straight to a PIL image
+    :return: PIL image of WIDTH x HEIGHT
+    """
+    labels = [string.ascii_uppercase[i] for i in range(0, len(variants))]
+    # prices are stored in cents and plotted in dollars
+    price_lists = [[int(price) / 100 for price in price_list] for price_list in price_lists]
+    font = get_font(12)
+
+    image = Image.new("RGB", (WIDTH, HEIGHT), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([PLOT_LEFT, PLOT_TOP, PLOT_RIGHT, PLOT_BOTTOM], fill=PLOT_BACKGROUND)
+
+    # axes ranges over every series
+    day_lists = [[datetime.strptime(str(d), "%Y-%m-%d").toordinal() for d in date_list] for date_list in date_lists]
+    prices = [float(price) for price_list in price_lists for price in price_list]
+    first_day = min(day_list[0] for day_list in day_lists)
+    last_day = max(day_list[-1] for day_list in day_lists)
+    day_span = max(last_day - first_day, 1)
+    lowest_price = min(prices)
+    highest_price = max(prices)
+    price_padding = (highest_price - lowest_price) * 0.05 or max(highest_price * 0.05, 1)
+    lowest_price -= price_padding
+    highest_price += price_padding
+
+    def to_x(day):
+        return PLOT_LEFT + (day - first_day) / day_span * (PLOT_RIGHT - PLOT_LEFT)
+
+    def to_y(price):
+        return PLOT_BOTTOM - (float(price) - lowest_price) / (highest_price - lowest_price) * (PLOT_BOTTOM - PLOT_TOP)
+
+    # vertical grid and date ticks
+    tick_count = min(day_span, 4)
+    for i in range(tick_count + 1):
+        day = first_day + round(i * day_span / tick_count)
+        x = to_x(day)
+        draw.line([(x, PLOT_TOP), (x, PLOT_BOTTOM)], fill="white", width=1)
+        tick_label = datetime.fromordinal(day).strftime("%b %d")
+        draw.text((x, PLOT_BOTTOM + 4), tick_label, fill="#2A3F5F", font=font, anchor="mt")
+
+    for i, (day_list, price_list) in enumerate(zip(day_lists, price_lists)):
+        colour = LINE_COLOURS[i % len(LINE_COLOURS)]
+        points = [(to_x(day), to_y(price)) for day, price in zip(day_list, price_list)]
+        if len(points) > 1:
+            draw.line(points, fill=colour, width=2, joint="curve")
+        else:
+            x, y = points[0]
+            draw.ellipse([x - 2, y - 2, x + 2, y + 2], fill=colour)
+
+        # start and end annotations
+        start_price = price_list[0]
+        end_price = price_list[-1]
+        draw.text((PLOT_LEFT - 0.05 * (PLOT_RIGHT - PLOT_LEFT), to_y(start_price)),
+                  '{}: ${:.2f}'.format(labels[i], start_price), fill="black", font=font, anchor="ld")
+        draw.text((PLOT_RIGHT, to_y(end_price)),
+                  '${:.2f} ({:.0%})'.format(end_price, (end_price / start_price) - 1), fill="black", font=font, anchor="lm")
+
+        # legend below the plot
+        legend_y = PLOT_BOTTOM + 40 + i * 18
+        draw.line([(PLOT_LEFT - 20, legend_y), (PLOT_LEFT + 10, legend_y)], fill=colour, width=2)
+        draw.text((PLOT_LEFT + 16, legend_y), labels[i] + ": " + items[i][:30] + "...- " + variants[i][:30],
+                  fill="black", font=font, anchor="lm")
+
+    # title
+    draw.text((PLOT_LEFT, PLOT_TOP - 8), chart_name, fill="rgb(37,37,37)", font=get_font(18), anchor="ld")
+
+    return image
@@ -5,11 +5,18 @@ import logging
 from datetime import datetime
 import shutil
 import string
-import db_models
+import db_utils
+import series_utils
 import sys
+import json
+import hashlib
 
 IMAGE_DESTINATION = "images/"
 SAMPLE_IMAGE_URL = f"{IMAGE_DESTINATION}sample.png"
+# Also write rendered charts to IMAGE_DESTINATION, charts are sent from memory either way
+PERSIST_IMAGES = False
+
+sample_image = None
 
 # Enable logging
 logging.basicConfig(
@@ -25,6 +32,8 @@ logger = logging.getLogger(__name__)
 def plot(date_lists, price_lists, variants, items, chart_name='Price Change'):
 
     labels = [string.ascii_uppercase[i] for i in range(0, len(variants))]
+    # prices are stored in cents and plotted in dollars
+    price_lists = [np.asarray(price_list, dtype=np.int64) / 100 for price_list in price_lists]
 
     fig = go.Figure()
 
@@ -76,14 +85,14 @@ def plot(date_lists, price_lists, variants, items, chart_name='Price Change'):
     for price_list, label in zip(price_lists, labels):
         annotations.append(dict(xref='paper', x=-0.05, y=price_list[0],
                                 xanchor='left', yanchor='bottom',
-                                text='{}: ${}'.format(label, price_list[0]),
+                                text='{}: ${:.2f}'.format(label, price_list[0]),
                                 font=dict(size=12),
                                 showarrow=False))
 
         annotations.append(dict(xref='paper', x=1, y=price_list[-1],
                                 xanchor='left', yanchor='middle',
-                                text='${} ({:.0%})'.format(price_list[-1],
-                                                           ((price_list[-1] / price_list[0])) - 1),
+                                text='${:.2f} ({:.0%})'.format(price_list[-1],
+                                                               ((price_list[-1] / price_list[0])) - 1),
                                 font=dict(size=12),
                                 showarrow=False))
 
@@ -100,11 +109,12 @@ def plot(date_lists, price_lists, variants, items, chart_name='Price Change'):
     return fig
 
 
-def update_image(chat_id, message_id, chart_name="Price Change"):
-    # retrieve chart
-    save_url = f"{IMAGE_DESTINATION}{chat_id}_{message_id}.png"
-    chart = db_models.Chart.objects.get(chart_id=message_id, chat_id=chat_id)
-
+def get_chart_data(chart):
+    """
+    Collect the series and names plotted for a chart
+    :param chart: Chart document
+    :return: dict of plotted data, None if none of the chart variants has a price series yet
+    """
     date_lists = []
     price_lists = []
     variants = []
@@ -112,34 +122,110 @@ def update_image(chat_id, message_id, chart_name="Price Change"):
     created_prices = []
     created_dates = []
 
+    price_series = get_price_series(chart.variants)
     for variant in chart.variants:
-        if len(variant.date_list) > 0:
-            date_lists.append(variant.date_list)
-            price_lists.append(variant.price_list)
+        if variant.variant_id in price_series:
+            date_list, price_list = price_series[variant.variant_id]
+            date_lists.append(date_list)
+            price_lists.append(price_list)
             variants.append(variant.variant_name)
             items.append(variant.item_name)
             created_prices.append(variant.created_price)
             created_dates.append(variant.created_time.date())
-            # print("variant added")
 
-    # print(date_lists)
-    if any(date_lists):
-        # print("plotting")
-        fig = plot(date_lists, price_lists, variants, items, chart_name)
-        fig.write_image(save_url)
-        logger.info(f"Image saved to: {save_url}")
-        labels = [string.ascii_uppercase[i] for i in range(0, len(variants))]
-        current_prices = [i[-1] for i in price_lists]
-        price_changes = [((ai/bi)-1)*100 for ai,bi in zip(current_prices, created_prices)]
-        return save_url, labels, current_prices, price_changes, created_dates
+    if date_lists:
+        return {
+            'date_lists': date_lists,
+            'price_lists': price_lists,
+            'variants': variants,
+            'items': items,
+            'created_prices': created_prices,
+            'created_dates': created_dates,
+        }
     else:
         return None
 
 
-def generate_photo_url(update, context):
+def get_price_series(variants):
+    """
+    :param variants: ChartVariant or ItemVariant documents
+    :return: dict of variant_id to (date_list, price_list) of the variants that have a price series
+    """
+    variant_ids = [variant.variant_id for variant in variants]
+    if db_utils.PRICE_OBSERVATIONS and db_utils.COMPACT_PRICE_SERIES:
+        item_variants = db_utils.retrieve_item_variants(variant_ids, "price_series")
+        price_series = {variant_id: series_utils.decode_price_series(item_variant.price_series)
+                        for variant_id, item_variant in item_variants.items() if item_variant.price_series}
+        # variants stored before their compact series was built
+        missing_ids = [variant_id for variant_id in variant_ids if variant_id not in price_series]
+        if missing_ids:
+            price_series.update(db_utils.retrieve_price_series(missing_ids))
+        return price_series
+    if db_utils.PRICE_OBSERVATIONS:
+        return db_utils.retrieve_price_series(variant_ids)
+
+    item_variants = {}
+    if db_utils.CHART_VARIANT_READ_THROUGH:
+        item_variants = db_utils.retrieve_item_variants(variant_ids, "date_list", "price_list")
+    price_series = {}
+    for variant in variants:
+        series = item_variants.get(variant.variant_id, variant)
+        if len(series.date_list) > 0:
+            price_series[variant.variant_id] = (series.date_list, series.price_list)
+    return price_series
+
+
+def get_chart_summary(chart_data):
+    labels = [string.ascii_uppercase[i] for i in range(0, len(chart_data['variants']))]
+    current_prices = [int(i[-1]) for i in chart_data['price_lists']]
+    price_changes = [((ai/bi)-1)*100 for ai,bi in zip(current_prices, chart_data['created_prices'])]
+    return labels, current_prices, price_changes, chart_data['created_dates']
+
+
+def get_chart_hash(chart_data, chart_name, caption):
+    """
+    Hash of what a chart message shows, used to skip unchanged charts.
+    Daily series are reduced to their price change points, so a chart that only grew by flat days hashes the same.
+    """
+    change_points = []
+    for date_list, price_list in zip(chart_data['date_lists'], chart_data['price_lists']):
+        change_points.append([(date_list[i], price_list[i]) for i in range(len(price_list))
+                              if i == 0 or price_list[i] != price_list[i - 1]])
+    content = json.dumps([change_points, chart_data['variants'], chart_data['items'], chart_name, caption],
+                         default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def get_image_url(chat_id, message_id):
+    return f"{IMAGE_DESTINATION}{chat_id}_{message_id}.png"
+
+
+def get_sample_image():
+    global sample_image
+    if sample_image is None:
+        with open(SAMPLE_IMAGE_URL, "rb") as f:
+            sample_image = f.read()
+    return sample_image
+
+
+def persist_image(image, chat_id, message_id):
+    if PERSIST_IMAGES:
+        save_url = get_image_url(chat_id, message_id)
+        with open(save_url, "wb") as f:
+            f.write(image)
+        logger.info(f"Image saved to: {save_url}")
+
+
+def get_figure(chart_data, chart_name="Price Change"):
+    fig = plot(chart_data['date_lists'], chart_data['price_lists'], chart_data['variants'], chart_data['items'], chart_name)
+    return fig
+
+
+def generate_photo(update, context):
+    """
+    :return: PNG chart of the chosen variants as bytes, None if none of them has a price history yet
+    """
     chart_name = context.chat_data['chart_name']
-    chat_id = str(update.message.chat.id)
-    TEMP_SAVE_URL = f"{IMAGE_DESTINATION}{chat_id}_temp.png"
 
     # check for existing charts
     date_lists = []
@@ -147,33 +233,29 @@ def generate_photo_url(update, context):
     variants = []
     items = []
     # logger.info(context.chat_data['chosen_variants'])
+    item_variants = db_utils.retrieve_item_variants([i['variant_id'] for i in context.chat_data['chosen_variants']])
+    price_series = get_price_series(item_variants.values())
     for chosen_variant in context.chat_data['chosen_variants']:
-        try:
-            logger.info(chosen_variant['variant_id'])
-            variant = db_models.ItemVariant.objects.get(_id=chosen_variant['variant_id'])
+        logger.info(chosen_variant['variant_id'])
+        variant = item_variants.get(chosen_variant['variant_id'])
+        if variant is None:
+            continue
 
-            variants.append(variant.variant_name)
-            items.append(variant.item_name)
-            if variant.date_list:
-                date_lists.append(variant.date_list)
-                price_lists.append(variant.price_list)
-                logger.info(f"Found {variant.variant_name}")
-        except db_models.ItemVariant.DoesNotExist:
-            variant = None
+        variants.append(variant.variant_name)
+        items.append(variant.item_name)
+        if variant.variant_id in price_series:
+            date_list, price_list = price_series[variant.variant_id]
+            date_lists.append(date_list)
+            price_lists.append(price_list)
+            logger.info(f"Found {variant.variant_name}")
 
     # if any variant already tracked before, display price history
     if len(date_lists) > 0:
         fig = plot(date_lists, price_lists, variants, items, chart_name)
-        fig.write_image(TEMP_SAVE_URL)
-        # chart = open(TEMP_SAVE_URL, "rb")
+        image = fig.to_image(format="png")
         update.message.reply_text("Hurray! Someone else was tracking the same items. Showing you the full price history. Check back daily for updates!")
-        return TEMP_SAVE_URL
+        return image
     # plot sample figure
     else:
         update.message.reply_text("Here's a sample of what the chart will look like after some time. Check back again tomorrow!")
-        # chart = open(SAMPLE_IMAGE_URL, "rb")
-        return SAMPLE_IMAGE_URL
-
-    # Store in context
-    context.chat_data['chart_id'] = chart_id
-    logger.info(f"CONTEXT: chart_id:{chart_id}")
+        return None
@@ -0,0 +1,87 @@
+from mongoengine import connect
+from datetime import datetime
+import db_models
+import logging
+import sys
+
+# Enable logging
+logging.basicConfig(
+                    filename="logs",
+                    filemode='a',
+                    format='%(asctime)s - %(module)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO,
+                    )
+logging.getLogger().addHandler(logging.StreamHandler())
+logger = logging.getLogger(__name__)
+
+LOCAL_DB_URI = "mongodb://localhost:27017"
+AUDIT_DATABASE = "eyesontheprice_audit"
+MODELS = [db_models.ItemVariant, db_models.Chart, db_models.Chat, db_models.ChangeSet, db_models.TelegramFile,
+          db_models.ShortUrl, db_models.ConversationState, db_models.ChatData, db_models.PriceObservation]
+
+
+def get_hot_queries():
+    """
+    :return: dict of name to the querysets run by the bot and the daily jobs
+    """
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    return {
+        "charts_by_variant": db_models.Chart.objects(variants__variant_id__in=["0"]),
+        "charts_to_notify": db_models.Chart.objects(threshold_hit=1, notified_count__lt=3),
+        "chart_by_message": db_models.Chart.objects(chat_id="0", chart_id="0"),
+        "item_variants_by_id": db_models.ItemVariant.objects(variant_id__in=["0"]),
+        "daily_sweep": db_models.ItemVariant.objects(channel="shopee").order_by("item_id", "shop_id"),
+        "chat_by_id": db_models.Chat.objects(chat_id="0"),
+        "change_set_today": db_models.ChangeSet.objects(created_time__gte=today).order_by('-created_time'),
+        "file_id_by_hash": db_models.TelegramFile.objects(content_hash="0"),
+        "short_urls_by_long_url": db_models.ShortUrl.objects(long_url__in=["0"]),
+        "conversation_state": db_models.ConversationState.objects(conversation_id="0"),
+        "chat_data": db_models.ChatData.objects(chat_id="0"),
+        "price_series": db_models.PriceObservation.objects(variant_id__in=["0"], date__gte=today)
+                                                  .order_by('variant_id', 'date'),
+    }
+
+
+def get_plan_stages(plan):
+    """
+    :return: every stage name in an explain() plan, including nested input stages
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages += get_plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += get_plan_stages(value)
+    return stages
+
+
+def audit_queries():
+    """
+    Explain every hot query
+    :return: names of the queries that scan a whole collection
+    """
+    for model in MODELS:
+        model.ensure_indexes()
+
+    collection_scans = []
+    for name, queryset in get_hot_queries().items():
+        stages = get_plan_stages(queryset.explain()['queryPlanner']['winningPlan'])
+        logger.info(f"{name}: {' <- '.join(stages)}")
+        if 'COLLSCAN' in stages:
+            collection_scans.append(name)
+    return collection_scans
+
+
+if __name__ == '__main__':
+    # python query_audit.py [mongodb uri], run against a local mongod, exits with 1 on a collection scan
+    db = connect(AUDIT_DATABASE, host=sys.argv[1] if len(sys.argv) > 1 else LOCAL_DB_URI)
+    collection_scans = audit_queries()
+    db.drop_database(AUDIT_DATABASE)
+    if collection_scans:
+        logger.error(f"Collection scans in {collection_scans}")
+        sys.exit(1)
+    logger.info("No hot query scans a whole collection.")
+    sys.exit()
@@ -0,0 +1,156 @@
+from abc import ABC, abstractmethod
+import plotly.graph_objects as go
+import plotly.io as pio
+import kaleido
+import plotly_utils
+import pillow_utils
+import multiprocessing
+import multiprocessing.util
+import threading
+import logging
+import time
+import io
+import os
+
+# Chart image backend, one of RENDERERS
+CHART_RENDERER = "plotly"
+RENDER_WORKERS = os.cpu_count() or 1
+RENDER_BATCH_SIZE = 50
+WARM_UP_TIMEOUT_SECONDS = 60
+
+# Enable logging
+logging.basicConfig(
+                    filename="logs",
+                    filemode='a',
+                    format='%(asctime)s - %(module)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO,
+                    )
+logging.getLogger().addHandler(logging.StreamHandler())
+logger = logging.getLogger(__name__)
+
+
+class Renderer(ABC):
+    """
+    Interface of the chart image backends
+    """
+    def warm_up(self):
+        pass
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def render(self, chart_data, chart_name):
+        """
+        :return: PNG image as bytes
+        """
+
+
+class PlotlyRenderer(Renderer):
+    def warm_up(self):
+        if not hasattr(kaleido, "start_sync_server"):
+            # older kaleido keeps its scope running once it has exported one figure
+            pio.to_image(go.Figure(), format="png")
+            return
+        # kaleido 1.x starts a new Chrome for every export unless its sync server is running
+        kaleido.start_sync_server(silence_warnings=True)
+        # the server thread dies quietly when Chrome does not start and exports then wait on it forever,
+        # so export one empty figure through it and stop it if that does not come back
+        export = threading.Thread(target=pio.to_image, args=(go.Figure(),), kwargs={'format': "png"}, daemon=True)
+        export.start()
+        export.join(WARM_UP_TIMEOUT_SECONDS)
+        if export.is_alive():
+            self.close()
+            raise RuntimeError(f"kaleido server did not export a figure in {WARM_UP_TIMEOUT_SECONDS}s")
+
+    def close(self):
+        if hasattr(kaleido, "stop_sync_server"):
+            kaleido.stop_sync_server(silence_warnings=True)
+
+    def render(self, chart_data, chart_name):
+        fig = plotly_utils.get_figure(chart_data, chart_name)
+        return fig.to_image(format="png")
+
+
+class PillowRenderer(Renderer):
+    def render(self, chart_data, chart_name):
+        image = pillow_utils.plot(chart_data['date_lists'], chart_data['price_lists'], chart_data['variants'],
+                                  chart_data['items'], chart_name)
+        image_bytes = io.BytesIO()
+        image.save(image_bytes, format="PNG")
+        return image_bytes.getvalue()
+
+
+RENDERERS = {
+    'plotly': PlotlyRenderer,
+    'pillow': PillowRenderer,
+}
+
+renderer = None
+
+
+def get_renderer(name=CHART_RENDERER):
+    return RENDERERS[name]()
+
+
+def init_renderer(name=CHART_RENDERER):
+    global renderer
+    renderer = get_renderer(name)
+    # pool workers skip atexit, their multiprocessing finalizers still run when they exit
+    multiprocessing.util.Finalize(renderer, renderer.close, exitpriority=0)
+    try:
+        renderer.warm_up()
+    except Exception as e:
+        # a failing initializer makes the pool respawn workers forever, let render_chart raise instead
+        logger.error(f"Renderer warm up failed: {e}")
+
+
+def render_chart(job):
+    chart_data, chart_name = job
+    return renderer.render(chart_data, chart_name)
+
+
+class RenderPool:
+    """
+    Pool of worker processes that keep a warm renderer and export batches of charts in parallel
+    """
+    def __init__(self, workers=RENDER_WORKERS, renderer_name=CHART_RENDERER):
+        self.workers = workers
+        self.renderer_name = renderer_name
+        self.pool = multiprocessing.Pool(workers, initializer=init_renderer, initargs=(renderer_name,))
+        self.rendered_count = 0
+        self.render_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def render(self, charts):
+        """
+        :param charts: list of (chart_data, chart_name)
+        :return: list of PNG images as bytes
+        """
+        start = time.perf_counter()
+        images = self.pool.map(render_chart, charts)
+        elapsed = time.perf_counter() - start
+        self.rendered_count += len(images)
+        self.render_seconds += elapsed
+        logger.info(f"Rendered {len(images)} charts with {self.renderer_name} in {elapsed:.2f}s")
+        return images
+
+    def get_metrics(self):
+        figures_per_second = self.rendered_count / self.render_seconds if self.render_seconds else 0.0
+        return {
+            'renderer': self.renderer_name,
+            'workers': self.workers,
+            'rendered_count': self.rendered_count,
+            'render_seconds': round(self.render_seconds, 3),
+            'figures_per_second': round(figures_per_second, 2),
+        }
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        logger.info(f"Render pool closed: {self.get_metrics()}")
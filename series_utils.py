@@ -0,0 +1,74 @@
+import numpy as np
+import struct
+
+# Compact price series: a header followed by the day offset and price in cents of every price change.
+# Days between changes carry the price of the change before them.
+SERIES_VERSION = 1
+# version, first day as days since 1970-01-01, number of days, number of changes
+SERIES_HEADER = struct.Struct("<BiII")
+
+
+def encode_price_series(dates, prices):
+    """
+    :param dates: dates of the observed prices in ascending order, as date strings, dates or datetime64
+    :param prices: observed prices in cents
+    :return: bytes of the compact series
+    """
+    days = np.asarray(dates, dtype="datetime64[D]").astype(np.int64)
+    cents = np.asarray(prices, dtype=np.int32)
+    # keep the first price and every price that differs from the one before
+    changes = np.concatenate(([True], cents[1:] != cents[:-1]))
+    offsets = (days[changes] - days[0]).astype(np.uint32)
+    return pack_price_series(int(days[0]), int(days[-1] - days[0]) + 1, offsets, cents[changes])
+
+
+def pack_price_series(start_day, length, offsets, cents):
+    header = SERIES_HEADER.pack(SERIES_VERSION, start_day, length, len(offsets))
+    return header + offsets.astype("<u4").tobytes() + cents.astype("<i4").tobytes()
+
+
+def unpack_price_series(data):
+    """
+    :return: first day, number of days, change day offsets and change prices in cents
+    """
+    version, start_day, length, count = SERIES_HEADER.unpack_from(data)
+    if version != SERIES_VERSION:
+        raise ValueError(f"Unknown price series version {version}")
+    offsets = np.frombuffer(data, dtype="<u4", count=count, offset=SERIES_HEADER.size)
+    cents = np.frombuffer(data, dtype="<i4", count=count, offset=SERIES_HEADER.size + 4 * count)
+    return start_day, length, offsets, cents
+
+
+def decode_price_series(data):
+    """
+    :param data: bytes of a compact series
+    :return: numpy arrays of every day as datetime64[D] and its price in cents
+    """
+    start_day, length, offsets, cents = unpack_price_series(data)
+    days = np.arange(length)
+    dates = np.datetime64(start_day, "D") + days
+    prices = cents[np.searchsorted(offsets, days, side="right") - 1]
+    return dates, prices
+
+
+def append_price_series(data, date, price):
+    """
+    End a compact series on date with price, replacing what was stored from that date on
+    :param data: bytes of a compact series, None to start one
+    :param price: price in cents
+    :return: bytes of the extended series
+    """
+    if not data:
+        return encode_price_series([date], [price])
+    start_day, length, offsets, cents = unpack_price_series(data)
+    offset = int(np.datetime64(date, "D").astype(np.int64)) - start_day
+    if offset < 0:
+        raise ValueError(f"{date} is before the start of the price series")
+    price_cents = int(price)
+    keep = offsets < offset
+    offsets = offsets[keep]
+    cents = cents[keep]
+    if len(cents) == 0 or cents[-1] != price_cents:
+        offsets = np.append(offsets, offset)
+        cents = np.append(cents, price_cents)
+    return pack_price_series(start_day, offset + 1, offsets, cents)
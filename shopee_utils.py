@@ -1,7 +1,11 @@
 import utils
 import urllib
 from urllib.parse import urlparse
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
 import logging
+import time
 
 logging.basicConfig(
                     filename="logs",
@@ -13,6 +17,87 @@ logging.getLogger().addHandler(logging.StreamHandler())
 logger = logging.getLogger(__name__)
 
 SHOPEE_PRICE_DENOMINATION = 100000
+SHOPEE_PRICE_PER_CENT = SHOPEE_PRICE_DENOMINATION // 100
+# Item details fetched for pasted links are reused for a few minutes, so a viral link is fetched once
+ITEM_CACHE_TTL_SECONDS = 300
+ITEM_CACHE_SIZE = 1024
+# Concurrent lookups of an item that is being fetched wait for that fetch instead of starting another
+COALESCE_ITEM_REQUESTS = True
+
+
+class ItemCache:
+    """
+    Thread-safe cache of item jsons with a TTL, evicting the least recently used item when full
+    """
+    def __init__(self, ttl_seconds=ITEM_CACHE_TTL_SECONDS, max_size=ITEM_CACHE_SIZE,
+                 coalesce=COALESCE_ITEM_REQUESTS):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.coalesce = coalesce
+        # key to (expiry time, item json), least recently used first
+        self.items = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hit_count = 0
+        self.miss_count = 0
+        self.coalesced_count = 0
+
+    def get(self, key, fetch):
+        """
+        :param fetch: function returning the item json, called on a miss
+        :return: cached item json, or the result of fetch
+        """
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.items.move_to_end(key)
+                self.hit_count += 1
+                return entry[1]
+            self.items.pop(key, None)
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced_count += 1
+            else:
+                self.miss_count += 1
+                if self.coalesce:
+                    self.in_flight[key] = Future()
+
+        if future is not None:
+            return future.result()
+
+        try:
+            item_json = fetch()
+        except Exception as e:
+            self.finish(key, exception=e)
+            raise
+        self.finish(key, item_json)
+        return item_json
+
+    def finish(self, key, item_json=None, exception=None):
+        with self.lock:
+            # error responses have no item and are not cached
+            if item_json is not None and item_json.get('item') is not None:
+                self.items[key] = (time.monotonic() + self.ttl_seconds, item_json)
+                self.items.move_to_end(key)
+                while len(self.items) > self.max_size:
+                    self.items.popitem(last=False)
+            future = self.in_flight.pop(key, None)
+        if future is not None:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(item_json)
+
+    def get_metrics(self):
+        return {
+            'hit_count': self.hit_count,
+            'miss_count': self.miss_count,
+            'coalesced_count': self.coalesced_count,
+            'size': len(self.items),
+        }
+
+
+item_cache = ItemCache()
 
 def extract_shopee_identifiers(url):
     # Identify whether app or web link
@@ -31,10 +116,19 @@ def extract_shopee_identifiers(url):
 def get_shopee_json(url):
     parameters = extract_shopee_identifiers(url)
     search_url = utils.build_search_url(utils.SHOPEE_SEARCH_LINK, parameters)
-    item_json = utils.retrieve_item_details_json(search_url)
+    item_json = item_cache.get((parameters['shopid'], parameters['itemid']),
+                               lambda: utils.retrieve_item_details_json(search_url))
     return item_json
 
 
+def get_price_cents(shopee_price):
+    """
+    :param shopee_price: price in Shopee's units of 1/SHOPEE_PRICE_DENOMINATION
+    :return: price in integer cents, rounded half up
+    """
+    return (int(shopee_price) + SHOPEE_PRICE_PER_CENT // 2) // SHOPEE_PRICE_PER_CENT
+
+
 def get_shopee_variants(item_json):
     # store item details in dict
     item_dict = {}
@@ -44,8 +138,8 @@ def get_shopee_variants(item_json):
     item_dict['shop_id'] = str(item_json['item']['shopid'])
 
     item_dict['item_description'] = item_json['item']['description']
-    item_dict['price_min'] = int(item_json['item']['price_min']) / SHOPEE_PRICE_DENOMINATION
-    item_dict['price_max'] = int(item_json['item']['price_max']) / SHOPEE_PRICE_DENOMINATION
+    item_dict['price_min'] = get_price_cents(item_json['item']['price_min'])
+    item_dict['price_max'] = get_price_cents(item_json['item']['price_max'])
     item_dict['currency'] = item_json['item']['currency']
     item_dict['item_brand'] = item_json['item']['brand']
     item_dict['item_sold'] = int(item_json['item']['historical_sold'])
@@ -68,11 +162,11 @@ def get_shopee_variants(item_json):
             'item_id': item_dict['item_id'],
             'item_name': item_dict['item_name'],
             'shop_id': item_dict['shop_id'],
-            'current_price': int(variant['price']) / SHOPEE_PRICE_DENOMINATION,
+            'current_price': get_price_cents(variant['price']),
             'currency_code': variant['currency'],
             'stock': int(variant['stock'])
         }
-        option = (f"{variant_dict['variant_name']} - ${variant_dict['current_price']:.2f} ({variant_dict['stock']} left)")
+        option = (f"{variant_dict['variant_name']} - ${utils.format_price(variant_dict['current_price'])} ({variant_dict['stock']} left)")
         variants.append(variant_dict)
         variants_display.append(option)
     # if list is empty, display main product price
@@ -84,11 +178,11 @@ def get_shopee_variants(item_json):
             'item_id': str(item_dict['item_id']),
             'item_name': item_dict['item_name'],
             'shop_id': item_dict['shop_id'],
-            'current_price': int(item_json['item']['price']) / SHOPEE_PRICE_DENOMINATION,
+            'current_price': get_price_cents(item_json['item']['price']),
             'currency_code': item_dict['currency'],
             'stock': int(item_dict['item_stock'])
         }
-        option = (f"{variant_dict['variant_name']} - ${variant_dict['current_price']:.2f} ({variant_dict['stock']} left)")
+        option = (f"{variant_dict['variant_name']} - ${utils.format_price(variant_dict['current_price'])} ({variant_dict['stock']} left)")
 
         variants.append(variant_dict)
         variants_display.append(option)
@@ -0,0 +1,15 @@
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import credentials
+except ImportError:
+    # credentials.py holds the deployment secrets and is not checked in
+    credentials = types.ModuleType("credentials")
+    credentials.TELEGRAM_TOKEN = "123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11"
+    credentials.BITLY_TOKENS = []
+    credentials.DB_URI = "mongodb://localhost"
+    sys.modules["credentials"] = credentials
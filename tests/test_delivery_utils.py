@@ -0,0 +1,144 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+import threading
+import json
+import time
+import pytest
+import telegram
+import delivery_utils
+
+
+class BotApiStub(BaseHTTPRequestHandler):
+    """
+    Fake Bot API answering sendMessage. A text starting with "flood" is rejected once with retry_after,
+    a text starting with "slow" is answered too late once and "down" every time, a text starting with "bad"
+    is always rejected.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            parameters = json.loads(body)
+        else:
+            parameters = {key: values[0] for key, values in parse_qs(body).items()}
+        chat_id = int(parameters['chat_id'])
+        text = parameters['text']
+        server = self.server
+        with server.lock:
+            server.calls.append((chat_id, text, time.monotonic()))
+            first_call = text not in server.seen
+            server.seen.add(text)
+
+        if text.startswith("flood") and first_call:
+            self.reply(429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                             "parameters": {"retry_after": server.retry_after}})
+            return
+        if (text.startswith("slow") and first_call) or text.startswith("down"):
+            time.sleep(server.slow_seconds)
+        if text.startswith("bad"):
+            self.reply(400, {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"})
+            return
+        with server.lock:
+            server.sent.append((chat_id, text, time.monotonic()))
+        self.reply(200, {"ok": True, "result": {"message_id": len(server.sent), "date": 0, "text": text,
+                                                "chat": {"id": chat_id, "type": "private"}}})
+
+    def reply(self, status, content):
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def bot_api():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BotApiStub)
+    server.lock = threading.Lock()
+    server.calls = []
+    server.sent = []
+    server.seen = set()
+    server.retry_after = 0.3
+    server.slow_seconds = 0.5
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def bot(bot_api):
+    request = telegram.utils.request.Request(con_pool_size=8)
+    return telegram.Bot(token="123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11", request=request,
+                        base_url=f"http://127.0.0.1:{bot_api.server_port}/bot")
+
+
+def send(delivery_queue, bot, chat_id, text):
+    return delivery_queue.submit(chat_id, bot.send_message, chat_id=chat_id, text=text, timeout=0.2)
+
+
+def get_sent(bot_api, chat_id):
+    return [(text, sent_time) for sent_chat_id, text, sent_time in bot_api.sent if sent_chat_id == chat_id]
+
+
+def test_calls_to_a_chat_are_sent_in_order_at_the_chat_rate(bot_api, bot):
+    with delivery_utils.DeliveryQueue(workers=4, chat_rate=5) as delivery_queue:
+        futures = [send(delivery_queue, bot, 1, f"message {i}") for i in range(4)]
+    assert [future.result().text for future in futures] == [f"message {i}" for i in range(4)]
+    sent = get_sent(bot_api, 1)
+    assert [text for text, _ in sent] == [f"message {i}" for i in range(4)]
+    gaps = [later - earlier for (_, earlier), (_, later) in zip(sent, sent[1:])]
+    assert min(gaps) >= 0.2 - 0.02
+
+
+def test_busy_chat_does_not_hold_up_other_chats(bot_api, bot):
+    with delivery_utils.DeliveryQueue(workers=4, chat_rate=2) as delivery_queue:
+        start = time.monotonic()
+        for i in range(6):
+            send(delivery_queue, bot, 1, f"busy {i}")
+        send(delivery_queue, bot, 2, "other").result()
+        other_sent = time.monotonic() - start
+    assert other_sent < 0.3
+    assert [text for text, _ in get_sent(bot_api, 1)] == [f"busy {i}" for i in range(6)]
+
+
+def test_retry_after_is_honoured(bot_api, bot):
+    with delivery_utils.DeliveryQueue(workers=2, chat_rate=10) as delivery_queue:
+        first = send(delivery_queue, bot, 1, "flood")
+        second = send(delivery_queue, bot, 1, "after flood")
+    assert first.result().text == "flood"
+    assert second.result().text == "after flood"
+    attempts = [call_time for _, text, call_time in bot_api.calls if text == "flood"]
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= bot_api.retry_after - 0.02
+    assert [text for text, _ in get_sent(bot_api, 1)] == ["flood", "after flood"]
+    assert delivery_queue.get_metrics() == {'sent_count': 2, 'retry_count': 1, 'failed_count': 0}
+
+
+def test_timed_out_calls_are_retried_with_backoff(bot_api, bot):
+    with delivery_utils.DeliveryQueue(workers=2, backoff_seconds=0.1) as delivery_queue:
+        future = send(delivery_queue, bot, 1, "slow")
+    assert future.result().text == "slow"
+    assert delivery_queue.get_metrics()['retry_count'] == 1
+
+
+def test_failed_calls_do_not_block_the_chat(bot_api, bot):
+    with delivery_utils.DeliveryQueue(workers=2, chat_rate=10, max_retries=2, backoff_seconds=0.05) as delivery_queue:
+        bad_request = send(delivery_queue, bot, 1, "bad request")
+        timed_out = send(delivery_queue, bot, 1, "down")
+        later = send(delivery_queue, bot, 1, "later")
+    with pytest.raises(telegram.error.BadRequest):
+        bad_request.result()
+    with pytest.raises(telegram.error.TelegramError, match="after 2 retries"):
+        timed_out.result()
+    assert later.result().text == "later"
+    texts = [text for _, text, _ in bot_api.calls]
+    assert texts.count("bad request") == 1
+    assert texts.count("down") == 3
+    assert delivery_queue.get_metrics() == {'sent_count': 1, 'retry_count': 2, 'failed_count': 2}
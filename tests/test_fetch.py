@@ -0,0 +1,99 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import threading
+import json
+import time
+import pytest
+import utils
+
+
+class ShopeeStub(BaseHTTPRequestHandler):
+    """
+    Fake Shopee item api. An item in server.failures is answered with its status that many times before it
+    succeeds, -1 fails every time. Items in server.delays are answered after that many seconds.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        item_id = int(parse_qs(urlparse(self.path).query)['itemid'][0])
+        server = self.server
+        with server.lock:
+            server.calls.append(item_id)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            status, count = server.failures.get(item_id, (200, 0))
+            failing = count != 0
+            if count > 0:
+                server.failures[item_id] = (status, count - 1)
+        try:
+            time.sleep(server.delays.get(item_id, 0))
+            if failing:
+                self.reply(status, {"error": status})
+            else:
+                self.reply(200, {"item": {"itemid": item_id, "price_min": 100000, "stock": 1, "models": []}})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def reply(self, status, content):
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def shopee_api(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ShopeeStub)
+    server.lock = threading.Lock()
+    server.calls = []
+    server.failures = {}
+    server.delays = {}
+    server.in_flight = 0
+    server.max_in_flight = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # a fresh session, so its retry adapter is built with the short backoff
+    monkeypatch.setattr(utils, "session", None)
+    monkeypatch.setattr(utils, "session_pool_size", 0)
+    monkeypatch.setattr(utils, "FETCH_BACKOFF_SECONDS", 0.01)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_urls(shopee_api, item_ids):
+    search_link = f"http://127.0.0.1:{shopee_api.server_port}/api/v2/item/get?"
+    return [utils.build_search_url(search_link, {"itemid": item_id, "shopid": 1}) for item_id in item_ids]
+
+
+def test_results_stay_in_order_under_concurrency(shopee_api):
+    item_ids = list(range(1, 41))
+    # earlier items are answered later, so responses arrive out of order
+    shopee_api.delays = {item_id: 0.05 * (item_id % 4 == 1) for item_id in item_ids}
+    item_jsons = utils.retrieve_item_details_jsons(get_urls(shopee_api, item_ids), max_workers=8)
+    assert [item_json['item']['itemid'] for item_json in item_jsons] == item_ids
+    assert 1 < shopee_api.max_in_flight <= 8
+
+
+@pytest.mark.parametrize("status", utils.RETRY_STATUSES)
+def test_throttling_and_server_errors_are_retried(shopee_api, status):
+    shopee_api.failures = {1: (status, 2)}
+    item_jsons = utils.retrieve_item_details_jsons(get_urls(shopee_api, [1, 2]), max_workers=2)
+    assert [item_json['item']['itemid'] for item_json in item_jsons] == [1, 2]
+    assert shopee_api.calls.count(1) == 3
+
+
+def test_none_after_the_final_failure(shopee_api):
+    shopee_api.failures = {1: (503, -1), 2: (404, -1)}
+    item_jsons = utils.retrieve_item_details_jsons(get_urls(shopee_api, [1, 2, 3]), max_workers=3)
+    assert item_jsons[:2] == [None, None]
+    assert item_jsons[2]['item']['itemid'] == 3
+    assert shopee_api.calls.count(1) == utils.FETCH_RETRIES + 1
+    # client errors are not retried
+    assert shopee_api.calls.count(2) == 1
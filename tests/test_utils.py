@@ -0,0 +1,56 @@
+from datetime import date, timedelta
+import random
+import numpy as np
+import pytest
+import utils
+
+
+def get_price_list_loop(history, length, fill_price):
+    # the per-variant loop that expand_price_histories replaced
+    price_list = np.empty(length)
+    price_list.fill(fill_price)
+    start = 0
+    for i in range(len(history) - 1):
+        end = start + utils.difference_in_days(history[i + 1][0], history[i][0])
+        price_list[start:end] = history[i][1]
+        start = end
+    price_list[start:] = history[-1][1]
+    return price_list
+
+
+def get_random_history(rng, first_date):
+    history = [(first_date, rng.randint(1, 10000))]
+    for _ in range(rng.randint(0, 8)):
+        # 0 days adds a second change on the same day
+        history.append((history[-1][0] + timedelta(days=rng.choice([0, 0, 1, 3, 30, 200])), rng.randint(1, 10000)))
+    return history
+
+
+@pytest.mark.parametrize("history, length", [
+    ([(date(2026, 1, 1), 500)], 5),
+    ([(date(2026, 1, 1), 500), (date(2026, 1, 3), 450), (date(2026, 1, 4), 600)], 6),
+    # same-day changes, the last one wins
+    ([(date(2026, 1, 1), 500), (date(2026, 1, 1), 480), (date(2026, 1, 2), 470), (date(2026, 1, 2), 490)], 4),
+    # changes after the end of the series
+    ([(date(2026, 1, 1), 500), (date(2026, 1, 3), 450), (date(2026, 2, 1), 300)], 5),
+    ([(date(2026, 1, 1), 500), (date(2026, 1, 6), 450)], 5),
+])
+def test_expand_price_histories_matches_loop(history, length):
+    expanded = utils.expand_price_histories([history], [length], [history[0][1]])[0]
+    np.testing.assert_array_equal(expanded, get_price_list_loop(history, length, history[0][1]))
+
+
+def test_expand_price_histories_matches_loop_in_one_batch():
+    rng = random.Random(5)
+    histories = [get_random_history(rng, date(2025, 1, 1) + timedelta(days=rng.randint(0, 300))) for _ in range(1000)]
+    lengths = [rng.randint(1, 400) for _ in histories]
+    fill_prices = [history[0][1] for history in histories]
+    for history, length, expanded in zip(histories, lengths,
+                                         utils.expand_price_histories(histories, lengths, fill_prices)):
+        np.testing.assert_array_equal(expanded, get_price_list_loop(history, length, history[0][1]))
+
+
+def test_expand_price_histories_fills_empty_histories():
+    expanded = utils.expand_price_histories([[], [(date(2026, 1, 1), 300)]], [3, 2], [700, 800])
+    np.testing.assert_array_equal(expanded[0], [700, 700, 700])
+    np.testing.assert_array_equal(expanded[1], [300, 300])
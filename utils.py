@@ -2,13 +2,21 @@ import tldextract
 import urllib
 from urllib.parse import urlparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import re
 import logging
 import shopee_utils
+import db_utils
 from bitlyshortener import Shortener
 import credentials
 from datetime import datetime
 import sys
+import hashlib
+import numpy as np
+import threading
+import time
 
 # Enable logging
 logging.basicConfig(
@@ -21,6 +29,30 @@ logging.getLogger().addHandler(logging.StreamHandler())
 logger = logging.getLogger(__name__)
 
 SHOPEE_SEARCH_LINK = "https://shopee.sg/api/v2/item/get?"
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5',
+}
+REQUEST_TIMEOUT = 10
+# Number of item details requests kept in flight by retrieve_item_details_jsons
+FETCH_CONCURRENCY = 8
+# Timeouts, connection errors and these statuses are retried with exponential backoff before a request fails
+FETCH_RETRIES = 3
+FETCH_BACKOFF_SECONDS = 1
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Shorten product urls in the background once the reply is sent, get_short_url picks up the result
+SHORTEN_AFTER_REPLY = True
+SHORTEN_WORKERS = 2
+# Background results not picked up within this many seconds belong to abandoned conversations and are dropped
+PENDING_SHORT_URL_SECONDS = 3600
+
+session = None
+session_pool_size = 0
+session_lock = threading.Lock()
+shortener = None
+shorten_executor = ThreadPoolExecutor(max_workers=SHORTEN_WORKERS)
+pending_short_urls = {}
+pending_short_urls_lock = threading.Lock()
 
 
 def extract_url(update, context):
@@ -62,13 +94,57 @@ def build_search_url(url, parameters):
     return final_url
 
 
-def retrieve_item_details_json(url):
-    headers = {
-        'User-Agent': 'Mozilla/5',
-    }
+def get_session(pool_size=FETCH_CONCURRENCY):
+    """
+    Shared keep-alive session, so repeated calls reuse pooled connections
+    :param pool_size: connections kept per host, the pool grows when a caller needs more than it holds
+    """
+    global session, session_pool_size
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            session.headers.update(REQUEST_HEADERS)
+        if pool_size > session_pool_size:
+            retry = Retry(total=FETCH_RETRIES, backoff_factor=FETCH_BACKOFF_SECONDS, status_forcelist=RETRY_STATUSES,
+                          allowed_methods=["GET"], raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session_pool_size = pool_size
+        return session
+
+
+def retrieve_item_details_json(url, http_session=None):
+    """
+    :raise requests.exceptions.RequestException: if the request fails or ends with an error status
+    """
+    if http_session is None:
+        http_session = get_session()
+    r = http_session.get(url, timeout=REQUEST_TIMEOUT)
+    r.raise_for_status()
+    return r.json()
 
-    r = requests.get(url, headers=headers).json()
-    return r
+
+def retrieve_item_details_json_or_none(url, http_session=None):
+    try:
+        return retrieve_item_details_json(url, http_session)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error(f"Failed to retrieve {url}: {e}")
+        return None
+
+
+def retrieve_item_details_jsons(urls, max_workers=FETCH_CONCURRENCY):
+    """
+    Fetch item details for many urls over a bounded pool of worker threads
+    :param urls: list of search urls
+    :param max_workers: maximum number of requests in flight
+    :return: list of item jsons in the same order as urls, None for requests that failed after their retries.
+    An item that no longer exists comes back as a json without the item, not as None
+    """
+    http_session = get_session(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        item_jsons = list(executor.map(retrieve_item_details_json_or_none, urls, [http_session] * len(urls)))
+    return item_jsons
 
 
 def parse_threshold(choice):
@@ -80,10 +156,84 @@ def parse_threshold(choice):
         return -100
 
 
+def get_shortener():
+    # One shortener for the process, so its in-memory cache outlives a single call
+    global shortener
+    if shortener is None:
+        shortener = Shortener(tokens=credentials.BITLY_TOKENS, max_cache_size=8192)
+    return shortener
+
+
 def shorten_url(long_urls):
-    shortener = Shortener(tokens=credentials.BITLY_TOKENS, max_cache_size=8192)
-    urls = shortener.shorten_urls(long_urls)
-    return urls
+    """
+    Shorten urls with bit.ly, urls shortened before are read from the database
+    :return: list of short urls in the same order as long_urls
+    """
+    short_urls = db_utils.retrieve_short_urls(long_urls)
+    new_long_urls = list(dict.fromkeys(url for url in long_urls if url not in short_urls))
+    if new_long_urls:
+        new_short_urls = dict(zip(new_long_urls, get_shortener().shorten_urls(new_long_urls)))
+        db_utils.store_short_urls(new_short_urls)
+        short_urls.update(new_short_urls)
+    logger.info(f"Shortened {len(long_urls)} urls, {len(new_long_urls)} with bit.ly")
+    return [short_urls[url] for url in long_urls]
+
+
+def shorten_url_later(long_url):
+    """
+    Start shortening long_url in the background, get_short_url returns the result
+    """
+    now = time.monotonic()
+    with pending_short_urls_lock:
+        for expired_url in [url for url, (submitted, _) in pending_short_urls.items()
+                            if now - submitted > PENDING_SHORT_URL_SECONDS]:
+            del pending_short_urls[expired_url]
+        if long_url not in pending_short_urls:
+            pending_short_urls[long_url] = (now, shorten_executor.submit(shorten_url, [long_url]))
+
+
+def get_short_url(long_url):
+    """
+    :return: short url of long_url, long_url itself if it could not be shortened
+    """
+    with pending_short_urls_lock:
+        _, future = pending_short_urls.pop(long_url, (None, None))
+    try:
+        if future is None:
+            return shorten_url([long_url])[0]
+        return future.result()[0]
+    except Exception as e:
+        logger.error(f"Failed to shorten {long_url}: {e}")
+        return long_url
+
+
+def get_chunks(iterable, size):
+    """
+    :return: generator of lists of up to size items, taken lazily from iterable in a single pass
+    """
+    # iterate once, a no_cache queryset restarts from the beginning on every iter()
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def format_price(cents):
+    """
+    :param cents: price in integer cents
+    :return: price in dollars for display, e.g. 1999 as 19.99
+    """
+    cents = int(cents)
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+
+def get_content_hash(content):
+    return hashlib.sha256(content).hexdigest()
 
 
 def get_current_date():
@@ -103,3 +253,36 @@ def difference_in_days(current, previous):
         day_diff = time_diff.days
         return day_diff
 
+
+def expand_price_histories(histories, lengths, fill_prices):
+    """
+    Expand many price histories into dense daily price series in one pass
+    :param histories: list of price histories, each a list of (date, price) changes in date order
+    :param lengths: number of days in each daily series, day 0 being the date of the first change
+    :param fill_prices: price of each series used when its history is empty
+    :return: list of numpy arrays of daily prices in cents, one per history
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    series_starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    counts = np.array([len(history) for history in histories], dtype=np.int64)
+    change_days = np.array([change[0].toordinal() for history in histories for change in history], dtype=np.int64)
+    change_prices = np.array([int(change[1]) for history in histories for change in history], dtype=np.int64)
+    change_series = np.repeat(np.arange(len(histories)), counts)
+
+    # day offset of every change from the first change of its own history
+    first_changes = np.concatenate(([0], np.cumsum(counts)[:-1]))[counts > 0]
+    first_days = np.repeat(change_days[first_changes], counts[counts > 0])
+    offsets = np.clip(change_days - first_days, 0, lengths[change_series])
+
+    # one fill entry at the start of every series, followed by its changes
+    positions = np.concatenate((series_starts, series_starts[change_series] + offsets))
+    prices = np.concatenate((np.asarray(fill_prices, dtype=np.int64), change_prices))
+    series = np.concatenate((np.arange(len(histories)), change_series))
+    kinds = np.concatenate((np.zeros(len(histories), dtype=np.int64), np.ones(len(change_prices), dtype=np.int64)))
+    order = np.lexsort((np.arange(len(positions)), kinds, series, positions))
+
+    # forward fill: each day takes the price of the latest entry at or before it
+    days = np.arange(lengths.sum())
+    latest = np.searchsorted(positions[order], days, side='right') - 1
+    daily_prices = prices[order][latest]
+    return np.split(daily_prices, series_starts[1:])